@@ -2,6 +2,7 @@ from laml_libs.ML_solver import *
 from math import exp,log
 import cvxpy as cp
 from laml_libs import min_llh, conv_eps, eps
+from laml_libs.mstep_lib import optimize_brlen_separable, optimize_brlen_closed_form, optimize_brlen_heights, optimize_nu_scalar
 import numpy as np
 import time
 
@@ -12,15 +13,13 @@ def log_sum_exp(numlist):
     result = maxx + log(sum([exp(x-maxx) for x in numlist]))
     return result
 
-def pseudo_log(x):
-    return log(x) if x>0 else min_llh
-
 class EM_solver(ML_solver):
     def __init__(self,treeList,data,prior,params={'nu':0,'phi':0,'sigma':0}):
         super(EM_solver,self).__init__(treeList,data,prior,params)
         self.has_polytomy = False
         self.__mark_polytomies__(eps_len=self.dmin*0.01)
-        self.num_edges = sum([len(list(tree.traverse_postorder())) for tree in self.trees])
+        self.__build_topology__()
+        self.num_edges = self.num_nodes
     
     def __mark_polytomies__(self,eps_len=0):
         # polytomy_mark and resolve all polytomies in self.tree_obj
@@ -40,273 +39,466 @@ class EM_solver(ML_solver):
                     self.num_polytomy_mark += 1
                     node.edge_length = eps_len  
                     self.has_polytomy = True              
-    
-    def x2brlen(self,x):
-        i = 0
-        for tree in self.trees:        
+
+    def __build_topology__(self):
+        # auxiliary function, shoudn't be called outside
+        # extend the array representation of the base class with the polytomy marks
+        super(EM_solver,self).__build_topology__()
+        if hasattr(self,'L0'):
+            self.out_state = None # the cache of optimize_local belongs to the previous topology
+        self.polytomy_mark = np.zeros(self.num_nodes,dtype=bool)
+        for tree in self.trees:
             for node in tree.traverse_postorder():
-                if not node.polytomy_mark:
-                    node.edge_length = x[i]
-                    i += 1
+                self.polytomy_mark[node.idx] = getattr(node,'polytomy_mark',False)
+
+    def get_tree_newick(self):
+        # the branches that resolve the polytomies (see __mark_polytomies__) are contracted, so the output trees keep the polytomies of the input
+        newicks = super(EM_solver,self).get_tree_newick()
+        if not np.any(self.polytomy_mark):
+            return newicks
+        out = []
+        for tree,tree_str in zip(self.trees,newicks):
+            tree_copy = read_tree_newick(tree_str)
+            for node,node_copy in zip(tree.traverse_postorder(),list(tree_copy.traverse_postorder())):
+                if self.polytomy_mark[node.idx]:
+                    node_copy.contract()
+            out.append(tree_copy.newick())
+        return out
+
+    def __collapsible__(self):
+        # auxiliary function, shoudn't be called outside
+        # the polytomy branches are not collapsed by optimize, which would leave multifurcations in the trees of the solver;
+        # they are contracted in the output instead (see get_tree_newick)
+        return super(EM_solver,self).__collapsible__() & ~self.polytomy_mark
+
+    def __node_arrays__(self):
+        # auxiliary function, shoudn't be called outside
+        # extend the per-node arrays of the base class with the polytomy marks and the alpha slots of the outside pass
+        # (the slots of a node only depend on its subtree, so they stay valid for the subtrees that are moved intact)
+        names = super(EM_solver,self).__node_arrays__() + ['polytomy_mark']
+        if hasattr(self,'L0'):
+            names += ['alpha_slots']
+        return names
+
+    def __free_edges__(self,local_brlen_opt=True):
+        # auxiliary function, shoudn't be called outside
+        # the mask of the branches whose lengths are free variables of the M-step
+        free = ~self.polytomy_mark
+        if local_brlen_opt:
+            free &= ~self.mark_fixed
+        return free
+
+    def x2brlen(self,x):
+        free = ~self.polytomy_mark
+        self.brlen[free] = x[:np.sum(free)]
     
     def ultrametric_constr(self,local_brlen_opt=True):
-        N = self.num_edges-self.num_polytomy_mark
-        if local_brlen_opt:
-            for tree in self.trees:
-                N -= len([node for node in tree.traverse_postorder() if node.mark_fixed])
-        constrs = {}        
-        idx = 0
-        for tree in self.trees: 
-            for node in tree.traverse_postorder():
-                if node.is_leaf():
-                    node.constraint = [0.]*N
-                    node.constant = node.edge_length if node.mark_fixed else 0
-                else:
-                    c1,c2 = node.children
-                    m = tuple(x-y for (x,y) in zip(c1.constraint,c2.constraint))
-                    m_compl = tuple(-x for x in m)
-                    c = c2.constant-c1.constant
-                    if sum([x!=0 for x in m]) > 0 and not (m in constrs or m_compl in constrs):
-                        constrs[m] = c
-                    node.constraint = c1.constraint
-                    if node.mark_fixed:
-                        node.constant = c1.constant + node.edge_length
-                    else:
-                        node.constant = c1.constant
-                if not node.polytomy_mark and not (node.mark_fixed and local_brlen_opt):    
-                    node.constraint[idx] = 1
-                    idx += 1
-        for tree in self.trees[1:]:
-            m = tuple(x-y for (x,y) in zip(self.trees[0].root.constraint,tree.root.constraint))
-            c = tree.root.constant-self.trees[0].root.constant
-            constrs[m] = c
-        M = []
-        b = []
-        for m in constrs:
-            M.append(list(m))
-            b.append(constrs[m])
+        # the ultrametric constraints on the free branches: M @ d = b, where M is a sparse (CSR) matrix
+        # the fixed branches contribute constants to b; the empty and duplicated rows are removed
+        free = self.__free_edges__(local_brlen_opt=local_brlen_opt)
+        N = int(np.sum(free))
+        col = np.cumsum(free)-1 # the column of each free branch in the constraint matrix
+        const_len = np.where(self.mark_fixed & ~free,self.brlen,0)
+        rows = self.__ultrametric_rows__(free,col,const_len)
+        constrs = {}
+        for k,(cols,vals,c) in enumerate(rows):
+            m = tuple(sorted(zip(cols,vals)))
+            m_compl = tuple((x,-y) for (x,y) in m)
+            is_root = k >= len(rows) - (len(self.roots)-1)
+            if is_root or (len(m) > 0 and not (m in constrs or m_compl in constrs)):
+                constrs[m] = c
+        indptr = np.cumsum([0]+[len(m) for m in constrs])
+        indices = [x for m in constrs for (x,_) in m]
+        data = [y for m in constrs for (_,y) in m]
+        M = csr_matrix((data,indices,indptr),shape=(len(constrs),N))
+        b = np.array([constrs[m] for m in constrs],dtype=float)
         return M,b
 
+    def ultrametric_heights(self,local_brlen_opt=True,region=None):
+        # parameterize the ultrametric trees by node heights; equivalent to the constraints of ultrametric_constr
+        # all leaves have height 0 and the tops of the root edges of all trees have the same height
+        # the nodes joined by non-free branches (fixed or polytomy) share one height variable up to a constant offset,
+        # the nodes tied to a leaf are pinned (their height is a constant)
+        # output: (par_col,child_col,c) such that the free branches (in the order of self.__free_edges__) satisfy
+        #   d = H[par_col] - H[child_col] + c, where H is the vector of height variables and H[-1] = 0 (pinned)
+        # the height variables are sorted such that child_col < par_col whenever both are variables
+        # returns None if the fixed branches are inconsistent with any ultrametric tree
+        # region: an optional sorted list of nodes (a connected part of one tree, ending at its top node) that contains 
+        #   all free branches; only the region and the parent of its top (or the tops of the root edges) are visited, 
+        #   and the other children of the visited nodes are pinned at their heights (see optimize_local)
+        free = self.__free_edges__(local_brlen_opt=local_brlen_opt)
+        n = self.num_nodes + 1
+        top = self.num_nodes # a virtual node that is the parent of all roots
+        group = [-1]*n # -1: pinned
+        offset = [0.]*n
+        members = {}
+        if region is None:
+            visit = list(self.postorder) + [top]
+        else:    
+            p = self.parent[region[-1]]
+            visit = list(region) + [p if p != -1 else top]
+        visited = set(visit)    
+        def __const_len__(u):
+            return self.brlen[u] if self.mark_fixed[u] else 0
+        for v in visit:
+            C = list(self.roots) if v == top else self.__children__(v)
+            if len(C) == 0:
+                continue
+            group[v] = v
+            members[v] = [v]
+            for u in C:
+                if free[u]:
+                    continue
+                if u not in visited:
+                    # the subtree of u has no free branch: u is pinned at the length of any path down to a leaf
+                    x = u
+                    while self.child[x] != -1:
+                        x = self.child[x]
+                        offset[u] += __const_len__(x)
+                # h_v = h_u + d_u where d_u is a constant
+                d_u = __const_len__(u)
+                gv,gu = group[v],group[u]
+                if gu == -1 and gv == -1:
+                    if not isclose(offset[v],offset[u]+d_u,abs_tol=1e-10):
+                        return None
+                    continue
+                # merge the two groups: the smaller one is moved into the other one (or into the pinned one)
+                if gv == -1 or (gu != -1 and len(members[gu]) <= len(members[gv])):
+                    g_from,g_to,delta = gu,gv,offset[v]-offset[u]-d_u
+                else:
+                    g_from,g_to,delta = gv,gu,offset[u]+d_u-offset[v]
+                for x in members.pop(g_from):
+                    group[x] = g_to
+                    offset[x] += delta
+                    if g_to != -1:
+                        members[g_to].append(x)
+        # sort the height variables by their topmost node
+        groups = sorted(members,key=lambda g: max(members[g]))
+        col = {g:j for j,g in enumerate(groups)}
+        col[-1] = -1
+        E = np.flatnonzero(free)
+        par_col = np.array([col[group[self.parent[v] if self.parent[v] != -1 else top]] for v in E],dtype=int)
+        child_col = np.array([col[group[v]] for v in E],dtype=int)
+        c = np.array([offset[self.parent[v] if self.parent[v] != -1 else top] - offset[v] for v in E],dtype=float)
+        return par_col,child_col,c
+
+    def __init_arena__(self):
+        # auxiliary function, shoudn't be called outside
+        # extend the arena of the base class with the storage of the E-step
+        if not super(EM_solver,self).__init_arena__():
+            return False
+        shape = (self.num_nodes,self.num_patterns)
+        self.out0 = np.zeros(shape)
+        self.out1 = np.zeros(shape)
+        self.A = np.zeros(shape)
+        self.X = np.zeros(shape)
+        self.alpha_slots = np.zeros((self.num_nodes,2,self.num_patterns),dtype=int)
+        self.out_alpha = np.zeros((self.num_nodes,2,self.num_patterns))
+        self.post0 = np.zeros(shape)
+        self.post1 = np.zeros(shape)
+        self.S_sum = np.zeros((5,self.num_nodes))
+        self.R = np.zeros(self.num_nodes)
+        self.R_tilde = np.zeros(self.num_nodes)
+        self.out_state = None # the state of the cached outside llh of optimize_local
+        return True
+
+    def __alpha_arrays__(self,i):
+        # auxiliary function, shoudn't be called outside
+        # read the alpha of node i from the arena as numpy masks of the z-branches and the masked ('?') branches
+        # and the vector log_q of the log prior probability of the alpha state at each site (0 if the branch is not an alpha-branch)
+        # and the vector of alpha states (0 if the branch is not an alpha-branch)
+        alpha = self.alpha[i]
+        return alpha == 0,alpha == -1,self.log_q[i],np.maximum(alpha,0)
+
     def Estep_in_llh(self):
-        # assume az_partition has been performed so each node has the attribute node.alpha
-        # compute the inside llh, store in L0 and L1 of each node
+        # assume az_partition has been performed so the arena holds the alpha of each node
+        # compute the inside llh, store in the rows i of self.L0 and self.L1 for each node i
+        # L0 and L1 are numpy vectors over all site patterns; the recursion runs on whole arrays, 
+        # with the 'z', '?', and alpha cases of each site selected by masks
+        # only the dirty nodes are recomputed (see ML_solver.__dirty_nodes__)
+        for i in self.__dirty_nodes__():
+            self.__in_llh_node__(i)
+
+    def __in_llh_node__(self,i):
+        # auxiliary function, shoudn't be called outside
+        # the inside llh of node i, from the inside llh of its children (see Estep_in_llh)
         phi = self.params.phi
         nu = self.params.nu
-        for tree in self.trees:
-            for node in tree.traverse_postorder():
-                p = exp(-node.edge_length)
-                node.L0 = [0]*self.numsites # L0 and L1 are stored in log-scale
-                node.L1 = [0]*self.numsites
-                for site in range(self.numsites):   
-                    q = self.Q[site][node.alpha[site]] if node.alpha[site] not in ['?','z'] else 1.0
-                    if node.is_leaf():
-                        if node.alpha[site] == "?":
-                            if self.charMtrx[node.label][site] == '?':
-                                masked_llh = log(1-(1-phi)*p**nu) if (1-(1-phi)*p**nu)>0 else min_llh
-                            else:
-                                masked_llh = log(1-p**nu) if (1-p**nu)>0 else min_llh           
-                            #masked_llh = log(1-(1-phi)*p**nu) if self.charMtrx[node.label][site] == '?' else log(1-p**nu)
-                            node.L0[site] = node.L1[site] = masked_llh
-                        elif node.alpha[site] == 'z':
-                            node.L0[site] = (nu+1)*(-node.edge_length) + log(1-phi) if 1-phi>0 else min_llh
-                            node.L1[site] = min_llh
-                        else:
-                            node.L0[site] = nu*(-node.edge_length) + log(1-p) + log(q) + log(1-phi) if (1-p)*q*(1-phi)>0 else min_llh
-                            node.L1[site] = nu*(-node.edge_length) + log(1-phi) if (1-phi)>0 else min_llh
-                    else:
-                        C = node.children
-                        l0 = l1 = 0
-                        for c in C:
-                            l0 += c.L0[site]
-                            l1 += c.L1[site]
-                        # note: l0_z, l0_alpha, and l0_masked are lists    
-                        l0_z = [l0 + (nu+1)*(-node.edge_length)]
-                        l0_alpha = [l1 + log(1-p)+log(q) + nu*(-node.edge_length)] if (node.alpha[site] != 'z' and q*(1-p)>0) else []
-                        l0_masked = [log(1-p**nu)] if (node.alpha[site] == '?' and (1-p**nu) > 0) else []
-                        node.L0[site] = log_sum_exp(l0_z + l0_alpha + l0_masked)
-                        if node.alpha[site] == 'z':
-                            node.L1[site] = min_llh
-                        elif node.alpha[site] != '?' or nu == 0 or p==1:
-                            node.L1[site] = l1 + nu*(-node.edge_length) 
-                        else:
-                            node.L1[site] = log_sum_exp([l1 + nu*(-node.edge_length), log(1-p**nu)])
+        d = self.brlen[i]
+        p = exp(-d)
+        is_z,is_masked,log_q,_ = self.__alpha_arrays__(i)
+        L0 = self.L0[i]
+        L1 = self.L1[i]
+        # L0 and L1 are stored in log-scale
+        if self.child[i] == -1:
+            is_alpha = ~(is_z | is_masked)
+            is_missing = self.is_missing[i]
+            # a leaf that represents k identical cells is observed (resp. dropped out) in all of them
+            k = self.multiplicity[i]
+            # masked sites: either missing ('?') or silenced (-1)
+            L0[is_masked & is_missing] = pseudo_log(1-(1-phi**k)*p**nu)
+            L0[is_masked & ~is_missing] = pseudo_log(1-p**nu)
+            L1[is_masked] = L0[is_masked]
+            # z-branches
+            L0[is_z] = (nu+1)*(-d) + k*pseudo_log(1-phi)
+            L1[is_z] = min_llh
+            # alpha-branches
+            L0[is_alpha] = nu*(-d) + pseudo_log(1-p) + log_q[is_alpha] + k*pseudo_log(1-phi)
+            L1[is_alpha] = nu*(-d) + k*pseudo_log(1-phi)
+        else:
+            C = self.__children__(i) # any number of children, as in ML_solver.lineage_llh
+            l0 = self.L0[C].sum(axis=0)
+            l1 = self.L1[C].sum(axis=0)
+            l0_z = l0 + (nu+1)*(-d)
+            l0_alpha = l1 + pseudo_log(1-p) + log_q + nu*(-d)
+            l0_masked = pseudo_log(1-p**nu)
+            L0[:] = np.where(is_z,l0_z,np.logaddexp(l0_z,l0_alpha))
+            L0[is_masked] = np.logaddexp(L0[is_masked],l0_masked)
+            L1[:] = np.where(is_z,min_llh,l1 + nu*(-d))
+            L1[is_masked] = np.logaddexp(L1[is_masked],l0_masked)
 
     def lineage_llh(self):
         # override the function of the base class
         self.Estep_in_llh()
         llh = 0
-        for tree in self.trees:
-            llh += sum(tree.root.L0)
+        for r in self.roots:
+            llh += np.dot(self.site_weights,self.L0[r])
         return llh
     
+    def __alpha_slots__(self):
+        # auxiliary function, shoudn't be called outside
+        # for each node u and each site, find the (at most two) alpha states a for which 
+        # the out_alpha of u, i.e. log P(~D_u,u=a), is queried by the outside pass
+        # a state is queried at u if it is the alpha of a child of u, or if it is queried 
+        # at a child of u whose sibling is masked ('?')
+        # output: fill self.alpha_slots (an integer array of shape (num_nodes,2,num_patterns); 0 means empty)
+        for u in self.postorder:
+            self.__alpha_slots_node__(u)
+
+    def __alpha_slots_node__(self,u):
+        # auxiliary function, shoudn't be called outside
+        # the alpha slots of node u, from the alpha and the slots of its children (see __alpha_slots__)
+        slots = self.alpha_slots[u]
+        if self.child[u] == -1:
+            slots[:] = 0
+            return
+        c1 = self.child[u]
+        c2 = self.sibling[c1]
+        _,m1,_,d1 = self.__alpha_arrays__(c1)
+        _,m2,_,d2 = self.__alpha_arrays__(c2)
+        c1_slots = self.alpha_slots[c1]
+        c2_slots = self.alpha_slots[c2]
+        s1 = d1.copy()
+        s2 = np.where(d2 != d1,d2,0)
+        # c2 is masked: inherit the queries of c1
+        s1 = np.where(m2,np.where(d1 != 0,d1,c1_slots[0]),s1)
+        s2 = np.where(m2,np.where(d1 != 0,0,c1_slots[1]),s2)
+        # c1 is masked: inherit the queries of c2
+        s1 = np.where(m1,np.where(d2 != 0,d2,c2_slots[0]),s1)
+        s2 = np.where(m1,np.where(d2 != 0,0,c2_slots[1]),s2)
+        slots[0] = s1
+        slots[1] = s2
+
+    def __lookup_out_alpha__(self,u,states):
+        # auxiliary function, shoudn't be called outside
+        # gather the out_alpha of u at the input alpha states (one per site); min_llh where the state is not in a slot of u
+        slots = self.alpha_slots[u]
+        out_alpha = self.out_alpha[u]
+        out = np.where(slots[1] == states,out_alpha[1],min_llh)
+        out = np.where(slots[0] == states,out_alpha[0],out)
+        return np.where(states != 0,out,min_llh)
+
     def Estep_out_llh(self):
-        # assume binary tree
+        # assume binary tree (the polytomies are resolved by __mark_polytomies__); a ValueError is raised otherwise
         # assume az_parition and Estep_in_llh have been performed 
-        # so that all nodes have `alpha`, `L0` and `L1` attribues
-        # output: add the attributes `out0` and `out1` to each node
-        # where v.out0 = P(~D_v,v=0) and v.out1 = P(~D_v,v=-1) 
-        for tree in self.trees:
-            for v in tree.traverse_preorder():
-                if v.is_root(): # base case
-                    # Auxiliary components
-                    v.A = [0]*self.numsites
-                    v.X = [-self.params.nu*v.edge_length + log(1-exp(-v.edge_length))]*self.numsites if self.params.nu*v.edge_length > 0 else [min_llh]*self.numsites
-                    v.out_alpha = [{} for i in range(self.numsites)]
-                    # Main components    
-                    v.out0 = [-(1+self.params.nu)*v.edge_length]*self.numsites
-                    v.out1 = [log(1-exp(-v.edge_length*self.params.nu))]*self.numsites if self.params.nu*v.edge_length > 0 else [min_llh]*self.numsites
-                else:
-                    u = v.parent
-                    w = None 
-                    # get the sister
-                    for x in u.children:
-                        if x is not v:
-                            w = x
-                            break
-                    #if w is None:
-                        #print("w is none", [x.label for x in u.traverse_leaves()])
-                        #print("w is none", len(u.children),u.is_root())
-                    # Auxiliary components
-                    v.A = [None]*self.numsites
-                    v.X = [None]*self.numsites
-                    v.out_alpha = [{} for i in range(self.numsites)]
-                    # Main components
-                    v.out0 = [None]*self.numsites
-                    v.out1 = [None]*self.numsites
-                    for site in range(self.numsites): 
-                        # compute out0: P(~D_v,v=0)
-                        v.out0[site] = u.out0[site] + w.L0[site] - (1+self.params.nu)*v.edge_length
-                        v.A[site] = u.out0[site] + w.L0[site] 
-                        v.X[site] = -self.params.nu*v.edge_length + log(1-exp(-v.edge_length)) + v.A[site] if v.edge_length > 0 else min_llh
-                        # compute out1: P(~D_v,v=-1)
-                        if w.alpha[site] == 'z': # z-branch
-                            v.out1[site] = log(1-exp(-v.edge_length*self.params.nu)) + v.A[site] if self.params.nu*v.edge_length > 0 else min_llh
-                        elif w.alpha[site] == '?': # masked branch
-                            v.X[site] = log_sum_exp([v.X[site],u.X[site]+w.L1[site]-self.params.nu*v.edge_length])
-                            p = 1-exp(-v.edge_length*self.params.nu) # if nu=0 then p=0
-                            pl = log(p) if p > 0 else min_llh
-                            v.out1[site] = u.out1[site] if self.params.nu == 0 else log_sum_exp([pl+v.A[site],pl+u.X[site]+w.L1[site],u.out1[site]])
-                        else:
-                            alpha0 = w.alpha[site] 
-                            if alpha0 not in u.out_alpha[site]:
-                                self.__out_alpha_up__(u,site,alpha0)
-                            B = u.out_alpha[site][alpha0] + self.params.nu*(-v.edge_length) + w.L1[site]  
-                            if v.edge_length > 0 and self.Q[site][alpha0] > 0:
-                                C = v.A[site] - self.params.nu*v.edge_length + log(1-exp(-v.edge_length)) + log(self.Q[site][alpha0])
-                            else:
-                                C = min_llh    
-                            v.out_alpha[site][alpha0] = log_sum_exp([B,C])
-                            v.X[site] = log_sum_exp([v.X[site],B])
-                            if self.params.nu*v.edge_length > 0:
-                                v.out1[site] = log(1-exp(-v.edge_length*self.params.nu)) + log_sum_exp([v.A[site],w.L1[site]+u.out_alpha[site][alpha0]])
-                            else:
-                                v.out1[site] = min_llh    
-
-    def __out_alpha_up__(self,node,site,alpha0):
+        # so that the arena holds `alpha`, `L0` and `L1` of all nodes
+        # output: fill the rows v of self.out0 and self.out1 for each node v
+        # where out0 = P(~D_v,v=0) and out1 = P(~D_v,v=-1) 
+        # all quantities are numpy vectors over all site patterns, computed in a single preorder sweep
+        # the per-state out_alpha are kept for the alpha states in `alpha_slots` (see __alpha_slots__) and 
+        # are stored without the prior factor: self.out_alpha[v][k] = log P(~D_v,v=a)-log(Q[a]) where a = self.alpha_slots[v][k]
+        # the auxiliary self.X[v] = log P(~D_v,v is in an alpha state), summed over all alpha states (with the prior factor)
+        if np.any(np.bincount(self.parent[self.parent != -1],minlength=self.num_nodes) > 2):
+            raise ValueError("Estep_out_llh: the outside pass only supports binary trees")
+        self.out_state = None # the cache of optimize_local is overwritten
+        self.__alpha_slots__()
+        for v in self.postorder[::-1]:
+            self.__out_llh_node__(v)
+
+    def __out_llh_node__(self,v):
         # auxiliary function, shoudn't be called outside
-        v = node
-        path = []   
-        # going up to until reaching either a z-branch or the root
-        while not v.is_root():
-            u = v.parent
-            for x in u.children:
-                if x is not v:
-                    w = x
-                    break
-            if w.alpha[site] != '?' and w.alpha[site] != alpha0: # the branch above u is a z-branch
-                #if v.edge_length > 0 and self.Q[site][alpha0] > 0:
-                #    v.out_alpha[site][alpha0] = v.A[site] - self.params.nu*v.edge_length + log(1-exp(-v.edge_length)) + log(self.Q[site][alpha0])
-                #else:    
-                #    v.out_alpha[site][alpha0] = min_llh
-                v.out_alpha[site][alpha0] = v.A[site] - self.params.nu*v.edge_length + pseudo_log(1-exp(-v.edge_length)) + pseudo_log(self.Q[site][alpha0])
-                break
-            path.append(v)
-            v = u
-        if v.is_root(): # no z-branch found along the way
-            #if v.edge_length > 0 and self.Q[site][alpha0]:
-            #    v.out_alpha[site][alpha0] = -self.params.nu*v.edge_length + log(1-exp(-v.edge_length)) + log(self.Q[site][alpha0])             
-            #else:
-            #    v.out_alpha[site][alpha0] = min_llh   
-            v.out_alpha[site][alpha0] = -self.params.nu*v.edge_length + pseudo_log(1-exp(-v.edge_length)) + pseudo_log(self.Q[site][alpha0])             
-        # going down to compute all the out_alpha along the path
-        while path:
-            v = path.pop()
-            u = v.parent
-            for x in u.children:
-                if x is not v:
-                    w = x
-            B = u.out_alpha[site][alpha0] + self.params.nu*(-v.edge_length) + w.L1[site]  
-            #if v.edge_length > 0 and self.Q[site][alpha0]:
-            #    C = v.A[site] - self.params.nu*v.edge_length + log(1-exp(-v.edge_length)) + log(self.Q[site][alpha0])
-            #else:
-            #    C = min_llh    
-            C = v.A[site] - self.params.nu*v.edge_length + pseudo_log(1-exp(-v.edge_length)) + pseudo_log(self.Q[site][alpha0])
-            v.out_alpha[site][alpha0] = log_sum_exp([B,C])
+        # the outside llh of node v, from the outside llh of its parent and the inside llh of its sibling (see Estep_out_llh)
+        nu = self.params.nu
+        d = self.brlen[v]
+        pl_nu = pseudo_log(1-exp(-d*nu)) # log of the silencing probability on the branch above v
+        pl_mut = pseudo_log(1-exp(-d)) # log of the mutation probability on the branch above v
+        A = self.A[v]
+        X = self.X[v]
+        out0 = self.out0[v]
+        out1 = self.out1[v]
+        if self.parent[v] == -1: # base case
+            # Auxiliary components
+            A[:] = 0
+            X[:] = -nu*d + log(1-exp(-d)) if nu*d > 0 else min_llh
+            self.out_alpha[v] = -nu*d + pl_mut
+            # Main components    
+            out0[:] = -(1+nu)*d
+            out1[:] = pl_nu
+            return
+        u = self.parent[v]
+        # get the sister
+        w = self.sibling[v] if self.sibling[v] != -1 else self.child[u]
+        w_z,w_masked,w_log_q,w_states = self.__alpha_arrays__(w)
+        w_L0 = self.L0[w]
+        w_L1 = self.L1[w]
+        # Auxiliary components
+        np.add(self.out0[u],w_L0,out=A)
+        X[:] = A - nu*d + pl_mut
+        # out_alpha of u at the alpha state of w 
+        u_out_alpha = self.__lookup_out_alpha__(u,w_states)
+        B = u_out_alpha + w_log_q - nu*d + w_L1
+        # Main components
+        out0[:] = A - (1+nu)*d
+        out1[:] = pl_nu + A # z-branch
+        # w is an alpha-branch
+        w_alpha = ~(w_z | w_masked) 
+        X[w_alpha] = np.logaddexp(X[w_alpha],B[w_alpha])
+        out1[w_alpha] = pl_nu + np.logaddexp(A[w_alpha],w_L1[w_alpha] + w_log_q[w_alpha] + u_out_alpha[w_alpha])
+        # w is masked
+        u_X = self.X[u]
+        X[w_masked] = np.logaddexp(X[w_masked],u_X[w_masked] + w_L1[w_masked] - nu*d)
+        out1[w_masked] = np.logaddexp(np.logaddexp(pl_nu + A[w_masked],pl_nu + u_X[w_masked] + w_L1[w_masked]),self.out1[u][w_masked])
+        # per-state out_alpha
+        for k in range(2):
+            a = self.alpha_slots[v][k]
+            compatible = w_masked | (w_states == a)
+            B_k = np.where(compatible,self.__lookup_out_alpha__(u,a) + w_L1 - nu*d,min_llh)
+            np.logaddexp(B_k,A - nu*d + pl_mut,out=self.out_alpha[v][k])
+
+    def __site_llh__(self,v):
+        # auxiliary function, shoudn't be called outside
+        # the llh of the tree of the internal node v at each site pattern, combined at v from the outside llh of v 
+        # and the inside llh of its children: P(D) = P(~D_v,v=0)P(D_v|v=0) + P(~D_v,v=-1)P(D_v|v=-1) + sum_a P(~D_v,v=a)P(D_v|v=a)
+        # it equals L0 of the root, but only needs the arena rows of v and its children
+        is_z,is_masked,log_q,states = self.__alpha_arrays__(v)
+        C = self.__children__(v)
+        in0 = self.L0[C].sum(axis=0) # log P(D_v|v=0)
+        in_alpha = self.L1[C].sum(axis=0) # log P(D_v|v=a) for the alpha states a compatible with D_v
+        out_alpha = np.where(is_masked,self.X[v],self.__lookup_out_alpha__(v,states) + log_q)
+        llh = np.where(is_z,in0 + self.out0[v],np.logaddexp(in0 + self.out0[v],out_alpha + in_alpha))
+        llh[is_masked] = np.logaddexp(llh[is_masked],self.out1[v][is_masked])
+        return llh
 
     def Estep_posterior(self):
-        # assume binary tree
         # assume az_parition, Estep_in_llh, and Estep_out_llh have been performed 
-        # so that all nodes have `alpha`, `L0`, `L1`, `out0`, and `out1` attribues
-        # output: add the attributes `S0-4` (refer to the paper for definitions; all S are NOT stored in log-scale)
-        # and `post0` and `post1` to each node where v.post0 = log P(v=0|D) and v.post1 = log P(v=-1|D) 
-        for tree in self.trees:
-            full_llh = tree.root.L0
-            for v in tree.traverse_preorder():
-                v.post0 = [None]*self.numsites
-                v.post1 = [None]*self.numsites
-                v.S0 = [None]*self.numsites
-                v.S1 = [None]*self.numsites
-                v.S2 = [None]*self.numsites
-                v.S3 = [None]*self.numsites
-                v.S4 = [None]*self.numsites
-                for site in range(self.numsites):
-                    # compute auxiliary values: v_in1 = log P(D_v|v=-1),v_in0 = log P(D_v|v=0), v_in_alpha = log P(D_v|v=alpha0)
-                    v_in1 = 0 if v.alpha[site] == '?' else None
-                    if v.is_leaf():
-                            c = self.charMtrx[v.label][site]
-                            if c == 0:
-                                v_in0 = log(1-self.params.phi)
-                            else:
-                                v_in0 = log(self.params.phi) if (c == '?' and self.params.phi > 0) else min_llh 
-                    else:    
-                        v1,v2 = v.children
-                        v_in0 = v1.L0[site] + v2.L0[site]                 
-                    # compute posterior
-                    v.post0[site] = v_in0 + v.out0[site] - full_llh[site] if v_in0 is not None else min_llh
-                    v.post1[site] = v_in1 + v.out1[site] - full_llh[site] if v_in1 is not None else min_llh                                     
-                    # compute S (note that all S values are NOT in log-scale)
-                    if v.alpha[site] == 'z': # z-branch
-                        v.S0[site] = 1.0
-                        v.S1[site] = v.S2[site] = v.S3[site] = v.S4[site] = 0.0
-                    elif v.is_root():
-                        v.S0[site] = exp(v_in0 + (1.0+self.params.nu)*(-v.edge_length) - v.L0[site])
-                        v.S2[site] = 0.0 if v.alpha[site] != '?' else (1.0-exp(-self.params.nu*v.edge_length))/exp(v.L0[site])
-                        v.S1[site] = 1.0-v.S0[site]-v.S2[site]
-                        v.S3[site] = v.S4[site] = 0.0
-                    else:
-                        u = v.parent
-                        v.S0[site] = exp(u.post0[site] + v_in0 + (1.0+self.params.nu)*(-v.edge_length) - v.L0[site])
-                        if v.alpha[site] != '?':
-                            v.S2[site] = 0.0
-                            v.S4[site] = 0.0
-                        else: # masked branch
-                            v.S2[site] = exp(u.post0[site]-v.L0[site])*(1.0-exp(-self.params.nu*v.edge_length))
-                            if (1.0-exp(u.post0[site])-exp(u.post1[site]) == 0) or (1.0-exp(-self.params.nu*v.edge_length) == 0):
-                                v.S4[site] = 0
-                            else:    
-                                v.S4[site] = (1.0-exp(u.post0[site])-exp(u.post1[site]))*(1.0-exp(-self.params.nu*v.edge_length))/exp(v.L1[site])
-                        v.S1[site] = exp(u.post0[site]) - v.S0[site] - v.S2[site] 
-                        v.S3[site] = 1.0-v.S0[site]-v.S1[site]-exp(v.post1[site])
-
-    def Estep(self):
-        self.Estep_in_llh()
+        # so that the arena holds `alpha`, `L0`, `L1`, `out0`, and `out1` of all nodes
+        # output: the fused E-step accumulates the sufficient statistics straight into per-edge arrays 
+        #   + self.S_sum: array of shape (5,num_nodes); self.S_sum[k][v] is the sum over all sites 
+        #     of Sk on the branch above v (refer to the paper for definitions; all S are NOT stored in log-scale)
+        #   + self.R and self.R_tilde: arrays of size num_nodes with the phi statistics of the leaves (0 for internal nodes)
+        # the per-site posteriors post0 = log P(v=0|D) and post1 = log P(v=-1|D) are kept in the rows v of self.post0 and self.post1
+        # (one column per site pattern; index the columns by self.site_index to get all sites)
+        for v in self.postorder[::-1]:
+            if self.parent[v] == -1: # the trees are stored one after another in the postorder
+                full_llh = self.L0[v]
+            self.__posterior_node__(v,full_llh)
+
+    def __posterior_node__(self,v,full_llh):
+        # auxiliary function, shoudn't be called outside
+        # the posteriors of node v and the sufficient statistics of the branch above v, from the posteriors of its parent
+        # full_llh: the llh of the tree of v at each site pattern (see Estep_posterior)
+        phi = self.params.phi
+        nu = self.params.nu
+        is_z,is_masked,_,_ = self.__alpha_arrays__(v)
+        d = self.brlen[v]
+        silence = 1.0-exp(-nu*d) # the silencing probability on the branch above v
+        # compute auxiliary values: v_in1 = log P(D_v|v=-1) (0 on the masked sites), v_in0 = log P(D_v|v=0)
+        if self.child[v] == -1:
+            is_missing = self.is_missing[v]
+            mult = self.multiplicity[v]
+            v_in0 = np.full(self.num_patterns,min_llh)
+            v_in0[is_z] = mult*pseudo_log(1-phi)
+            v_in0[is_missing] = mult*pseudo_log(phi)
+        else:    
+            v_in0 = self.L0[self.__children__(v)].sum(axis=0)
+        # compute posterior
+        post0 = self.post0[v]
+        post1 = self.post1[v]
+        post0[:] = v_in0 + self.out0[v] - full_llh
+        post1[:] = np.where(is_masked,self.out1[v] - full_llh,min_llh)
+        v_L0 = self.L0[v]
+        # compute S (note that all S values are NOT in log-scale)
+        with np.errstate(over='ignore',divide='ignore',invalid='ignore'):
+            if self.parent[v] == -1:
+                S0 = np.exp(v_in0 + (1.0+nu)*(-d) - v_L0)
+                S2 = np.where(is_masked,silence*np.exp(-v_L0),0.0)
+                S1 = 1.0-S0-S2
+                S3 = S4 = np.zeros(self.num_patterns)
+            else:
+                u_post0 = self.post0[self.parent[v]]
+                u_post1 = self.post1[self.parent[v]]
+                S0 = np.exp(u_post0 + v_in0 + (1.0+nu)*(-d) - v_L0)
+                # masked branches
+                S2 = np.where(is_masked,np.exp(u_post0-v_L0)*silence,0.0)
+                u_post_alpha = 1.0-np.exp(u_post0)-np.exp(u_post1)
+                S4 = np.where(is_masked & (u_post_alpha != 0) & (silence != 0),u_post_alpha*silence/np.exp(self.L1[v]),0.0)
+                S1 = np.exp(u_post0) - S0 - S2 
+                S3 = 1.0-S0-S1-np.exp(post1)
+        # z-branches; each site pattern is weighted by its multiplicity    
+        w = self.site_weights
+        for k,Sk in enumerate([S0,S1,S2,S3,S4]):
+            self.S_sum[k][v] = np.dot(w[~is_z],Sk[~is_z]) + (np.sum(w[is_z]) if k == 0 else 0)
+        if self.child[v] == -1:
+            self.R[v] = mult*np.sum(w[~is_missing])
+            self.R_tilde[v] = mult*np.dot(w[is_missing],1-np.exp(post1[is_missing]))
+
+    def Estep(self,in_llh=True):
+        # in_llh: set to False to skip the inside pass when self.L0 and self.L1 already hold the inside llh 
+        # of the current parameters (e.g. right after lineage_llh); the output is the same
+        if in_llh:
+            self.Estep_in_llh()
         self.Estep_out_llh()
         self.Estep_posterior()
 
-    def Mstep(self,optimize_phi=True,optimize_nu=True,verbose=1,eps_nu=1e-5,eps_s=1e-6,ultra_constr_cache=None,local_brlen_opt=True):
-    # assume that Estep have been performed so that all nodes have S0-S4 attributes
+    def __brlen_conic_problem__(self,N,ultra_constr_cache=None):
+        # auxiliary function, shoudn't be called outside
+        # the conic formulation of the branch-length subproblem of the M-step, written in DPP form
+        # so that it is compiled once and only the parameters are updated in later EM iterations
+        # var_w >= exp(-nu*var_d) is an auxiliary variable that keeps the objective DPP (it is tight at the optimum)
+        var_d = cp.Variable(N,nonneg=True) # the branch length variables
+        var_w = cp.Variable(N)
+        a = cp.Parameter(N,nonneg=True) # (nu+1)*S0 + nu*(S1+S3)
+        S1 = cp.Parameter(N,nonneg=True)
+        S24 = cp.Parameter(N,nonneg=True) # S2 + S4
+        nu = cp.Parameter(pos=True)
+        objective = cp.Maximize(-a @ var_d + S1 @ cp.log(1-cp.exp(-var_d)) + S24 @ cp.log(1-var_w))
+        constraints = [np.zeros(N)+self.dmin <= var_d, var_d <= np.zeros(N)+self.dmax, var_w >= cp.exp(-nu*var_d), var_w <= 1]
+        if ultra_constr_cache is not None:
+            M,b = ultra_constr_cache
+            constraints += [M @ var_d == b]
+        prob = cp.Problem(objective,constraints)
+        return prob,var_d,var_w,(a,S1,S24,nu)
+
+    def __nu_conic_problem__(self,N):
+        # auxiliary function, shoudn't be called outside
+        # the conic formulation of the nu subproblem of the M-step in DPP form (see __brlen_conic_problem__)
+        # the terms that do not depend on nu are dropped; var_w >= exp(-var_nu*d)
+        var_nu = cp.Variable(nonneg=True) # the nu variable
+        var_w = cp.Variable(N)
+        c = cp.Parameter(nonneg=True) # (S0+S1+S3) @ d
+        d = cp.Parameter(N,pos=True)
+        S24 = cp.Parameter(N,nonneg=True) # S2 + S4
+        objective = cp.Maximize(-c*var_nu + S24 @ cp.log(1-var_w))
+        prob = cp.Problem(objective,[var_w >= cp.exp(-cp.multiply(d,var_nu)), var_w <= 1])
+        return prob,var_nu,var_w,(c,d,S24)
+
+    def Mstep(self,optimize_phi=True,optimize_nu=True,verbose=1,eps_nu=1e-5,eps_s=1e-6,ultra_constr_cache=None,ultra_heights_cache=None,conic_cache=None,local_brlen_opt=True):
+    # assume that Estep have been performed so that self.S_sum, self.R, and self.R_tilde are available
     # output: optimize all parameters: branch lengths, phi, and nu
     # verbose level: 1 --> show all messages; 0 --> show minimal messages; -1 --> completely silent        
+    # conic_cache: an optional dictionary that keeps the compiled conic problems across the M-steps of one EM run
+    # ultra_constr_cache, ultra_heights_cache: the ultrametric constraints in the forms of ultrametric_constr and ultrametric_heights;
+    #   the branch lengths are ultrametric if either one is given (the conic fallback is only used with ultra_constr_cache)
         if not optimize_phi:
             if verbose > 0:
                 print("Fixing phi to " + str(self.params.phi))    
@@ -314,54 +506,53 @@ class EM_solver(ML_solver):
         else:       
             if verbose > 0:
                 print("Optimizing phi")
-            R = []
-            R_tilde = []
-            for tree in self.trees:
-                for v in tree.traverse_leaves():
-                    R.append(sum([x != '?' for x in self.charMtrx[v.label]]))
-                    R_tilde.append(sum([1-exp(p) for (j,p) in enumerate(v.post1) if self.charMtrx[v.label][j] == '?'])) 
-            phi_star = sum(R_tilde)/(sum(R)+sum(R_tilde))
+            phi_star = np.sum(self.R_tilde)/(np.sum(self.R)+np.sum(self.R_tilde))
             if abs(phi_star) < 1/(self.numsites*len(self.charMtrx)):
                 phi_star = 0
         # optimize nu and all branch lengths
-        N = self.num_edges-self.num_polytomy_mark
-        if local_brlen_opt:
-            for tree in self.trees:
-                N -= len([node for node in tree.traverse_postorder() if node.mark_fixed])
-        S0 = np.zeros(N)
-        S1 = np.zeros(N)
-        S2 = np.zeros(N)
-        S3 = np.zeros(N)
-        S4 = np.zeros(N)
-        d_ini = np.zeros(N)
-        i = 0
-        for tree in self.trees:
-            for v in tree.traverse_postorder():
-                if not v.polytomy_mark and not (v.mark_fixed and local_brlen_opt):    
-                    s = [sum(v.S0),sum(v.S1),sum(v.S2),sum(v.S3),sum(v.S4)]
-                    s = [max(eps_s,x) for x in s]
-                    #s = [x if x > eps_s else 0 for x in s]
-                    s = [x/sum(s)*self.numsites for x in s]
-                    S0[i],S1[i],S2[i],S3[i],S4[i] = s
-                    d_ini[i] = v.edge_length
-                    i += 1
+        free = self.__free_edges__(local_brlen_opt=local_brlen_opt)
+        N = int(np.sum(free))
+        s = np.maximum(eps_s,self.S_sum[:,free])
+        #s = [x if x > eps_s else 0 for x in s]
+        s = s/np.sum(s,axis=0)*self.numsites
+        S0,S1,S2,S3,S4 = s
+        d_ini = self.brlen[free]
         def __optimize_brlen__(nu,verbose=False): # nu is a single number
-            var_d = cp.Variable(N,nonneg=True) # the branch length variables
-            C0 = -(nu+1)*S0.T @ var_d
-            C1 = -nu*S1.T @ var_d + S1.T @ cp.log(1-cp.exp(-var_d)) 
-            C2 = S2.T @ cp.log(1-cp.exp(-nu*var_d)) if sum(S2) > 0 and nu > eps_nu else 0 
-            C3 = -nu*S3.T @ var_d
-            C4 = S4.T @ cp.log(1-cp.exp(-nu*var_d)) if sum(S4) > 0 and nu > eps_nu else 0
-
-            objective = cp.Maximize(C0+C1+C2+C3+C4)
-            constraints = [np.zeros(N)+self.dmin <= var_d, var_d <= np.zeros(N)+self.dmax]             
-            if ultra_constr_cache is not None:
-                M,b = ultra_constr_cache
-                constraints += [np.array(M) @ var_d == np.array(b)]
-            prob = cp.Problem(objective,constraints)
+            # dedicated solvers for the separable concave objective (see mstep_lib);
+            # the conic formulation is only used as a fallback
+            if ultra_constr_cache is None and ultra_heights_cache is None:
+                if nu <= eps_nu: # e.g. no silencing: closed-form solution
+                    d,status = __compute_brlen__(nu)
+                else:    
+                    d,status = optimize_brlen_separable(s,nu,self.dmin,self.dmax,eps_nu=eps_nu)
+            else:
+                height_param = ultra_heights_cache if ultra_heights_cache is not None else self.ultrametric_heights(local_brlen_opt=local_brlen_opt)
+                if height_param is None:
+                    return d_ini,"infeasible"
+                d,status = optimize_brlen_heights(s,nu,self.dmin,self.dmax,height_param,d_ini,eps_nu=eps_nu)
+            if status == "optimal" or (ultra_constr_cache is None and ultra_heights_cache is not None): 
+                # the conic fallback needs the ultrametric constraints in the form of ultra_constr_cache
+                return d,status
+            return __optimize_brlen_conic__(nu,verbose=verbose)
+
+        def __optimize_brlen_conic__(nu,verbose=False): # nu is a single number
+            if conic_cache is not None and 'brlen' in conic_cache:
+                prob,var_d,var_w,(a,p_S1,p_S24,p_nu) = conic_cache['brlen']
+            else:
+                prob,var_d,var_w,(a,p_S1,p_S24,p_nu) = self.__brlen_conic_problem__(N,ultra_constr_cache=ultra_constr_cache)
+                if conic_cache is not None:
+                    conic_cache['brlen'] = prob,var_d,var_w,(a,p_S1,p_S24,p_nu)
+            a.value = (nu+1)*S0 + nu*(S1+S3)
+            p_S1.value = S1
+            # the terms of S2 and S4 are dropped if nu is negligible; var_w is then a dummy variable
+            p_S24.value = S2+S4 if nu > eps_nu else np.zeros(N)
+            p_nu.value = nu if nu > eps_nu else 1
+            # warm start from the current branch lengths
+            var_d.value = d_ini
+            var_w.value = np.exp(-p_nu.value*d_ini)
             #prob.solve(verbose=True,solver=cp.ECOS,max_iters=100000)
             #prob.solve(verbose=False,solver=cp.MOSEK)
-            prob.solve(verbose=False,solver=cp.MOSEK)
+            prob.solve(verbose=False,solver=cp.MOSEK,warm_start=True)
             return var_d.value,prob.status
        
         def __optimize_brlen_scipy__(nu):
@@ -378,34 +569,45 @@ class EM_solver(ML_solver):
             if ultra_constr_cache is not None:
                 #M,b = self.ultrametric_constr(local_brlen_opt=local_brlen_opt)
                 M,b = ultra_constr_cache
-                constraints.append(optimize.LinearConstraint(csr_matrix(M),[0]*len(M),[0]*len(M),keep_feasible=False))
+                constraints.append(optimize.LinearConstraint(M,b,b,keep_feasible=False))
             out = optimize.minimize(f, x0, method="SLSQP", options={'disp':True,'iprint':3,'maxiter':1000}, bounds=bounds,constraints=constraints)    
             status = "optimal" if out.success else out.message
             return out.x,status
 
-        def __compute_brlen__():
-            tmp = S0/(S0 + S1)
-            d = -np.log(tmp)
-            return d, "optimal"
+        def __compute_brlen__(nu):
+            # d = -log(S0/(S0+S1)) if nu = 0, clipped to [dmin,dmax] (see mstep_lib)
+            return optimize_brlen_closed_form(s,nu,self.dmin,self.dmax,eps_nu=eps_nu)
 
         def __optimize_nu__(d): # d is a vector of all branch lengths
-            var_nu = cp.Variable(1,nonneg=True) # the nu variable
-            C0 = -(var_nu+1)*S0.T @ d
-            C1 = -var_nu*S1.T @ d + S1.T @ cp.log(1-cp.exp(-d))
-            C2 = S2.T @ cp.log(1-cp.exp(-var_nu*d)) if sum(S2) > 0 else 0
-            C3 = -var_nu*S3.T @ d
-            C4 = S4.T @ cp.log(1-cp.exp(-var_nu*d)) if sum(S4) > 0 else 0
-            objective = cp.Maximize(C0+C1+C2+C3+C4)
-            prob = cp.Problem(objective)
-            prob.solve(verbose=False,solver=cp.MOSEK)
+            # nu is a single scalar, so it is found by a 1-D Newton search (see mstep_lib); 
+            # the conic formulation is only used as a fallback
+            nu,status = optimize_nu_scalar(s,d,nu_ini=self.params.nu)
+            if status == "optimal":
+                return nu,status
+            return __optimize_nu_conic__(d)
+
+        def __optimize_nu_conic__(d):
+            if conic_cache is not None and 'nu' in conic_cache:
+                prob,var_nu,var_w,(c,p_d,p_S24) = conic_cache['nu']
+            else:
+                prob,var_nu,var_w,(c,p_d,p_S24) = self.__nu_conic_problem__(N)
+                if conic_cache is not None:
+                    conic_cache['nu'] = prob,var_nu,var_w,(c,p_d,p_S24)
+            c.value = np.dot(S0+S1+S3,d)
+            p_d.value = d
+            p_S24.value = S2+S4
+            # warm start from the current nu
+            var_nu.value = max(self.params.nu,eps_nu)
+            var_w.value = np.exp(-var_nu.value*d)
+            prob.solve(verbose=False,solver=cp.MOSEK,warm_start=True)
             #prob.solve(verbose=False,solver=cp.ECOS,max_iters=400)
-            return var_nu.value[0],prob.status
+            return float(var_nu.value),prob.status
 
         nIters = 1
         nu_star = self.params.nu
         # [deprecated]: will always scale to timescale! cannot use closed-form solution
         #if (nu_star == 0): 
-        #    d_star,status_d = __compute_brlen__()
+        #    d_star,status_d = __compute_brlen__(nu_star)
         #    status_nu = "optimal"
         #else:
         for r in range(nIters):
@@ -436,12 +638,7 @@ class EM_solver(ML_solver):
         # place the optimal value back to params
         self.params.phi = phi_star
         self.params.nu = nu_star
-        i = 0
-        for tree in self.trees:
-            for node in tree.traverse_postorder():
-                if not node.polytomy_mark and not (node.mark_fixed and local_brlen_opt):    
-                    node.edge_length = d_star[i]
-                    i += 1
+        self.brlen[free] = d_star
         success = (status_d == "optimal" or status_d == "UNKNOWN") and (status_nu == "optimal" or status_nu == "UNKNOWN")
         if success:
             status = "optimal"
@@ -453,13 +650,19 @@ class EM_solver(ML_solver):
                 status = ",failed_nu"
         return success, status
     
-    def EM_optimization(self,verbose=1,optimize_phi=True,optimize_nu=True,ultra_constr=False,maxIter=1000):
+    def EM_optimization(self,verbose=1,optimize_phi=True,optimize_nu=True,ultra_constr=False,maxIter=1000,warn_maxIter=True,accelerate=False):
         # assume that az_partition has been performed
         # optimize all parameters: branch lengths, phi, and nu
         # if optimize_phi is False, it is fixed to the original value in params.phi
         # the same for optimize_nu
         # caution: this function will modify params in place!
         # verbose level: 1 --> show all messages; 0 --> show minimal messages; -1 --> completely silent
+        # warn_maxIter: warn if the EM stops at maxIter before convergence (turned off when the EM is meant to be resumed later)
+        # accelerate: extrapolate the EM map of (branch lengths,phi,nu) by SQUAREM (Varadhan and Roland, 2008). Each accelerated iteration 
+        #   takes two EM steps, extrapolates along them, and stabilizes the extrapolated point by one more EM step. 
+        #   The extrapolation is discarded in favor of the two plain EM steps if it leaves the feasible region or decreases the llh.
+        #   All points are affine combinations of EM iterates, so the ultrametric constraints are preserved.
+        #   maxIter and the reported number of iterations count the EM steps
         pre_llh = self.lineage_llh()
         if verbose >= 0:
             print("Initial phi: " + str(self.params.phi) + ". Initial nu: " + str(self.params.nu) + ". Initial nllh: " + str(-pre_llh))
@@ -467,31 +670,96 @@ class EM_solver(ML_solver):
         converged = False
         if ultra_constr:
             ultra_constr_cache = self.ultrametric_constr(local_brlen_opt=True) 
+            ultra_heights_cache = self.ultrametric_heights(local_brlen_opt=True)
         else:
             ultra_constr_cache = None        
-        while em_iter <= maxIter:
+            ultra_heights_cache = None
+        conic_cache = {}
+        free = self.__free_edges__(local_brlen_opt=True)
+
+        def __EM_step__(em_iter,in_llh=True):
+            # one EM step; in_llh = False reuses the inside pass of the last lineage_llh (see Estep)
+            # output: (m_success,status)
             if verbose > 0:
                 print("Starting EM iter: " + str(em_iter))
                 print("Estep")
             estep_start = time.time()
-            self.Estep()
+            self.Estep(in_llh=in_llh)
             estep_end = time.time()
             if verbose > 0:
                 print(f"Estep runtime (s): {estep_end - estep_start}")
                 print("Mstep")
             mstep_start = time.time()
-            m_success,status=self.Mstep(optimize_phi=optimize_phi,optimize_nu=optimize_nu,verbose=verbose,local_brlen_opt=True,ultra_constr_cache=ultra_constr_cache)
+            m_success,status=self.Mstep(optimize_phi=optimize_phi,optimize_nu=optimize_nu,verbose=verbose,local_brlen_opt=True,ultra_constr_cache=ultra_constr_cache,ultra_heights_cache=ultra_heights_cache,conic_cache=conic_cache)
             mstep_end = time.time()
             if verbose > 0:
                 print(f"Mstep runtime (s): {mstep_end - mstep_start}")
-            if not m_success:
-                if status == "d_infeasible": # should only happen with local EM
+            if not m_success and status != "d_infeasible" and verbose >= 0:    
+                print("Warning: EM failed to optimize parameters in one Mstep.")                
+            return m_success,status
+
+        def __get_x__():
+            return np.concatenate([self.brlen[free],[self.params.phi,self.params.nu]])
+
+        def __set_x__(x):
+            self.brlen[free] = x[:-2]
+            self.params.phi = x[-2]
+            self.params.nu = x[-1]
+
+        def __feasible__(x):
+            d = x[:-2]
+            return np.all(d >= self.dmin) and np.all(d <= self.dmax) and 0 <= x[-2] < 1 and x[-1] >= 0
+
+        while em_iter <= maxIter:
+            # the inside pass of the last lineage_llh (pre_llh or curr_llh) belongs to the current parameters, 
+            # so the first E-step of each iteration starts from it
+            if not accelerate or em_iter+2 > maxIter:
+                m_success,status = __EM_step__(em_iter,in_llh=False)
+                if not m_success and status == "d_infeasible": # should only happen with local EM
                     if verbose >= 0:
                         print("Warning: EM failed to optimize parameters in one Mstep due to infeasible constraints") 
                     return -pre_llh, em_iter,status
-                elif verbose >= 0:    
-                    print("Warning: EM failed to optimize parameters in one Mstep.")                
-            curr_llh = self.lineage_llh()
+                curr_llh = self.lineage_llh()
+            else:
+                # SQUAREM: two plain EM steps x0 -> x1 -> x2
+                x0 = __get_x__()
+                for k in range(2):
+                    m_success,status = __EM_step__(em_iter+k,in_llh=(k > 0))
+                    if not m_success and status == "d_infeasible": # should only happen with local EM
+                        if verbose >= 0:
+                            print("Warning: EM failed to optimize parameters in one Mstep due to infeasible constraints") 
+                        return -pre_llh, em_iter+k,status
+                    if k == 0:
+                        x1 = __get_x__()
+                x2 = __get_x__()
+                em_iter += 1
+                curr_llh = self.lineage_llh()
+                # the step length alpha <= -1; alpha = -1 gives x2
+                r = x1 - x0
+                v = x2 - x1 - r
+                norm_v = np.linalg.norm(v)
+                alpha = -np.linalg.norm(r)/norm_v if norm_v > 0 else -1
+                for _ in range(10):
+                    if alpha >= -1:
+                        break
+                    x = x0 - 2*alpha*r + alpha**2*v
+                    if __feasible__(x):
+                        break
+                    alpha = (alpha-1)/2    
+                if alpha < -1 and __feasible__(x):
+                    # stabilize the extrapolated point by one EM step and keep it only if it improves on x2
+                    __set_x__(x)
+                    m_success,status_x = __EM_step__(em_iter+1)
+                    llh_x = self.lineage_llh() if m_success else min_llh
+                    em_iter += 1
+                    if llh_x >= curr_llh:
+                        curr_llh = llh_x
+                        status = status_x
+                    else:
+                        if verbose > 0:
+                            print("Rejected the SQUAREM step")
+                        __set_x__(x2)
+                        curr_llh = self.lineage_llh()
             if verbose > 0:
                 print("Finished EM iter: " + str(em_iter) + ". Current nllh: " + str(-curr_llh))
             if abs((curr_llh - pre_llh)/pre_llh) < conv_eps:
@@ -501,11 +769,122 @@ class EM_solver(ML_solver):
                 break
             pre_llh = curr_llh
             em_iter += 1
-        if not converged and verbose >= 0:
+        if not converged and warn_maxIter and verbose >= 0:
             print("Warning: exceeded maximum number of EM iterations (" + str(maxIter) + " iters)!")
         return -curr_llh, em_iter,status    
 
-    def optimize_one(self,randseed,fixed_phi=None,fixed_nu=None,verbose=1,ultra_constr=False):
+    def optimize_local(self,moves,ultra_constr=False,maxIter=1000):
+    # Purpose: apply a local rearrangement of the trees (e.g. an NNI, see move_subtrees) and optimize the branches next to it by EM,
+    # with phi, nu, and all other branch lengths fixed (the same problem as score_tree with fixed_phi, fixed_nu, and fixed_brlen)
+    # the free branches are the ones above the nodes whose children changed and above the children of these nodes;
+    # the E-step only visits the region R that spans the free branches: the rest of the tree enters R through the outside llh 
+    # of the parent of its top node, which is cached from a full E-step of the tree before the moves, so each EM iteration 
+    # costs O(|R| x sites) instead of O(n x sites). The cache is refreshed by a full E-step only if the tree or the parameters 
+    # have changed since (e.g. after an accepted move); all rows of the arena written here are restored at the end.
+    # Output: (nllh,status,undo), where nllh is None if the optimization failed and undo is the list of moves that undo the 
+    # rearrangement (see move_subtrees); the optimized branch lengths are kept in self.brlen 
+        if not hasattr(self,'L0'):
+            self.az_partition()
+        missing = np.isnan(self.brlen)
+        if np.any(missing): # e.g. a root edge without length
+            self.brlen[missing] = np.array(self.ini_brlens())[missing]
+        phi = self.params.phi
+        nu = self.params.nu
+        # the cache is stale if the tree or the parameters have changed, or if the inside llh belong to other branch lengths
+        state = self.out_state
+        if (state is None or state[2] != phi or state[3] != nu or not np.array_equal(state[0],self.brlen) 
+            or not np.array_equal(state[1],self.parent) or self.in_state is None or not np.array_equal(self.in_state[0],self.brlen)):
+            self.Estep()
+            self.out_state = (self.brlen.copy(),self.parent.copy(),phi,nu)
+        undo = self.move_subtrees(moves)
+        # the nodes whose children changed (in the new indices), the free branches, and the region R up to the LCA r
+        T = set(i for (x,y,_) in undo for i in (y,self.parent[x]))
+        F = set(T)
+        for i in T:
+            F.update(self.__children__(i))
+        F = sorted(F)
+        r = self.__lca__(list(T))
+        R = set()
+        for i in F:
+            while i not in R:
+                R.add(i)
+                if i == r:
+                    break
+                i = self.parent[i]
+        R = sorted(R) # in postorder, so r is the last one
+        p = self.parent[r]
+        self.mark_fixed[:] = True
+        self.mark_fixed[F] = False
+        brlen_ini = self.brlen[F]
+        # save the rows of the outside pass that are overwritten 
+        out_names = ['out0','out1','A','X','out_alpha','alpha_slots','post0','post1']
+        saved = {}
+        def __save__(i):
+            if i not in saved:
+                saved[i] = {name:getattr(self,name)[i].copy() for name in out_names}
+        for i in R + ([p] if p != -1 else []):
+            __save__(i)
+        L0_ini = self.L0[R].copy()
+        L1_ini = self.L1[R].copy()
+        # the alpha slots of R, and of the ancestors of r as long as they change (their out_alpha is then extended to the new slots)
+        for i in R:
+            self.__alpha_slots_node__(i)
+        chain = []
+        u = p
+        while u != -1:
+            __save__(u)
+            self.__alpha_slots_node__(u)
+            if np.array_equal(self.alpha_slots[u],saved[u]['alpha_slots']):
+                break
+            chain.append(u)
+            u = self.parent[u]
+        for u in reversed(chain):
+            self.__out_llh_node__(u)
+        # the llh of the other trees is constant    
+        root = self.roots[np.searchsorted(self.roots,r)]
+        w = self.site_weights
+        other_llh = sum(np.dot(w,self.L0[x]) for x in self.roots if x != root)
+
+        def __local_llh__():
+            for i in R:
+                self.__in_llh_node__(i)
+            full_llh = self.__site_llh__(p) if p != -1 else self.L0[r].copy()
+            return np.dot(w,full_llh) + other_llh,full_llh
+
+        heights = self.ultrametric_heights(local_brlen_opt=True,region=R) if ultra_constr else None
+        if ultra_constr and heights is None:
+            m_success,status = False,"d_infeasible"
+        else:    
+            llh,full_llh = __local_llh__()
+            pre_llh = llh
+            for em_iter in range(maxIter):
+                for v in reversed(R):
+                    self.__out_llh_node__(v)
+                if p != -1:
+                    self.__posterior_node__(p,full_llh)
+                for v in reversed(R):
+                    self.__posterior_node__(v,full_llh)
+                m_success,status = self.Mstep(optimize_phi=False,optimize_nu=False,verbose=-1,local_brlen_opt=True,ultra_heights_cache=heights)
+                if not m_success:
+                    break
+                llh,full_llh = __local_llh__()
+                if abs((llh - pre_llh)/pre_llh) < conv_eps:
+                    break
+                pre_llh = llh
+        # restore the arena; the inside llh of R are recomputed by the next inside pass    
+        for i,rows in saved.items():
+            for name,row in rows.items():
+                getattr(self,name)[i] = row
+        self.L0[R] = L0_ini
+        self.L1[R] = L1_ini
+        self.mark_dirty(R)
+        self.mark_fixed[:] = False
+        if not m_success:
+            self.brlen[F] = brlen_ini
+            return None,status,undo
+        return -llh,status,undo
+
+    def optimize_one(self,randseed,fixed_phi=None,fixed_nu=None,verbose=1,ultra_constr=False,accelerate=False):
         # optimize using a specific initial point identified by the input randseed
         # verbose level: 1 --> show all messages; 0 --> show minimal messages; -1 --> completely silent
         seed(a=randseed)
@@ -514,8 +893,61 @@ class EM_solver(ML_solver):
         x0 = self.ini_all(fixed_phi=fixed_phi,fixed_nu=fixed_nu)
         self.x2params(x0,fixed_phi=fixed_phi,fixed_nu=fixed_nu)
         self.az_partition()
-        nllh,em_iter,status = self.EM_optimization(verbose=verbose,optimize_phi=(fixed_phi is None),optimize_nu=(fixed_nu is None),ultra_constr=ultra_constr)
+        nllh,em_iter,status = self.EM_optimization(verbose=verbose,optimize_phi=(fixed_phi is None),optimize_nu=(fixed_nu is None),ultra_constr=ultra_constr,accelerate=accelerate)
         if verbose >= 0:
             print("EM finished after " + str(em_iter) + " iterations.")
             print("Optimal phi: " + str(self.params.phi) + ". Optimal nu: " + str(self.params.nu) + ". Optimal nllh: " + str(nllh))
         return nllh,status
+
+    def __race_initial__(self,rep,randseed,brlen_ini,state=None,maxIter=1000,fixed_phi=None,fixed_nu=None,verbose=1,ultra_constr=False,accelerate=False):
+        # auxiliary function, shoudn't be called outside
+        # run at most maxIter EM iterations from the initial point rep (identified by randseed) of self.optimize,
+        # or continue the EM of that initial point from a saved state (brlen,phi,nu)
+        # output: the tuple (nllh,rep,state,status,finished), where finished is False if the EM was stopped by maxIter
+        if state is None:
+            if verbose >= 0:
+                print("Initial point " + str(rep+1) + ". Random seed: " + str(randseed))
+            self.brlen[:] = brlen_ini
+            seed(a=randseed)
+            x0 = self.ini_all(fixed_phi=fixed_phi,fixed_nu=fixed_nu)
+            self.x2params(x0,fixed_phi=fixed_phi,fixed_nu=fixed_nu)
+        else:
+            if verbose >= 0:
+                print("Continue initial point " + str(rep+1))
+            brlen,phi,nu = state
+            self.brlen[:] = brlen
+            self.params.phi = phi
+            self.params.nu = nu
+        self.az_partition()
+        nllh,em_iter,status = self.EM_optimization(verbose=verbose,optimize_phi=(fixed_phi is None),optimize_nu=(fixed_nu is None),ultra_constr=ultra_constr,maxIter=maxIter,warn_maxIter=(state is not None),accelerate=accelerate)
+        return (nllh,rep,(self.brlen.copy(),self.params.phi,self.params.nu),status,em_iter <= maxIter)
+
+    def __optimize_initials__(self,reps,randseeds,brlen_ini,options,threads=1,race_iters=0,race_margin=0):
+        # auxiliary function, shoudn't be called outside
+        # racing of the initial points: all initial points first run race_iters EM iterations, then the ones whose nllh trails
+        # the best one by more than race_margin (relative) are dropped and only the others continue to convergence
+        # the EM of a surviving initial point is resumed exactly where it stopped, so its result is the same as without racing
+        maxIter = 1000 # the default of EM_optimization
+        if race_iters <= 0 or race_iters >= maxIter or len(reps) <= 1:
+            return super(EM_solver,self).__optimize_initials__(reps,randseeds,brlen_ini,options,threads=threads)
+        verbose = options['verbose']
+        tasks = [('__race_initial__',(rep,randseed,brlen_ini),{'maxIter':race_iters}) for (rep,randseed) in zip(reps,randseeds)]
+        race_results = self.__run_tasks__(tasks,options,threads=threads)
+        best_nllh = min(nllh for (nllh,_,_,_,_) in race_results)
+        finished = []
+        tasks = []
+        for (nllh,rep,state,status,done) in race_results:
+            if done:
+                finished.append((nllh,rep,state,status,done))
+            elif nllh - best_nllh <= race_margin*abs(best_nllh):
+                tasks.append(('__race_initial__',(rep,None,brlen_ini),{'state':state,'maxIter':maxIter-race_iters}))
+            elif verbose >= 0:
+                print("Initial point " + str(rep+1) + " is dropped after " + str(race_iters) + " EM iterations. Current nllh: " + str(nllh) + ". Best nllh: " + str(best_nllh))
+        finished += self.__run_tasks__(tasks,options,threads=threads)
+        results = []
+        for (nllh,rep,(brlen,phi,nu),status,_) in finished:
+            self.brlen[:] = brlen
+            self.params.phi = phi
+            self.params.nu = nu
+            results.append(self.__initial_result__(nllh,rep,status,verbose=verbose))
+        return results
@@ -8,7 +8,28 @@ from laml_libs import min_llh, eps, nni_conv_eps, dmin, dmax
 from laml_libs.Virtual_solver import Virtual_solver
 from scipy.sparse import csr_matrix
 from copy import deepcopy
-from laml_libs.lca_lib import find_LCAs
+from multiprocessing import Pool
+from laml_libs.lca_lib import Anchor_index
+from laml_libs.sequence_lib import encode_charMtrx, encode_priors, MISSING
+
+def pseudo_log(x):
+    return log(x) if x>0 else min_llh
+
+# the solver of the worker processes of ML_solver.optimize (see __multistart_init__)
+__multistart_solver__ = None
+
+def __multistart_init__(solver,options):
+    # auxiliary function, shoudn't be called outside
+    # pool initializer: each worker keeps its own copy of the solver and the read-only data (character matrix, priors)
+    global __multistart_solver__
+    __multistart_solver__ = (solver,options)
+
+def __multistart_run__(task):
+    # auxiliary function, shoudn't be called outside
+    # a task is a tuple (method name, args, kwargs) of the solver (see ML_solver.__run_tasks__)
+    solver,options = __multistart_solver__
+    method,args,kwargs = task
+    return getattr(solver,method)(*args,**kwargs,**options)
 
 class Params:
     def __init__(self,nu,phi):
@@ -21,7 +42,10 @@ class ML_solver(Virtual_solver):
         Q = prior['Q']
         nu = params['nu']
         phi = params['phi']
-        self.charMtrx = charMtrx
+        # the character matrix can be given either as a dictionary or as a CharMtrx; it is kept as a CharMtrx
+        self.charMtrx = encode_charMtrx(charMtrx)
+        # optional: the number of identical cells represented by each leaf (see duplicate_lib); 1 for the leaves not listed
+        self.leaf_weights = data['leaf_weights'] if 'leaf_weights' in data else {}
         self.trees = []
         self.num_edges = 0
         for tree in treeList:
@@ -29,140 +53,500 @@ class ML_solver(Virtual_solver):
             tree_obj.suppress_unifurcations()
             self.num_edges += len(list(tree_obj.traverse_postorder()))
             self.trees.append(tree_obj)
-        # normalize Q
-        self.Q = []
-        for Q_i in Q:
-            s = sum([Q_i[x] for x in Q_i])
-            Q_i_norm = {x:Q_i[x]/s for x in Q_i}
-            self.Q.append(Q_i_norm)        
+        # normalize Q into a dense array of shape (numsites, max_state+1), together with its log
+        max_state = int(self.charMtrx.X.max()) if self.charMtrx.X.size > 0 else 0
+        self.Q = encode_priors(Q,max_state=max_state)
+        with np.errstate(divide='ignore'):
+            self.log_Q = np.log(self.Q)
         # setup params
         self.params = Params(nu,phi)        
         # compute numsites, num_edges, dmin, and dmax 
-        self.numsites = len(self.charMtrx[next(iter(self.charMtrx.keys()))])
+        self.numsites = self.charMtrx.X.shape[1]
         self.dmin = dmin
-        zerocount = sum([self.charMtrx[e].count(0) for e in self.charMtrx])
+        zerocount = np.sum(self.charMtrx.X == 0)
         totalcount = self.numsites * len(self.charMtrx)
         if totalcount == 0:
             print("WARNING: Number of sites in input character matrix detected as 0! Check delimiter?")
         zeroprop = zerocount/totalcount
         #self.dmax = -log(zeroprop) if zeroprop != 0 else 10
         self.dmax = dmax
+        self.__compress_sites__()
+        self.__build_topology__()
+
+    def __compress_sites__(self):
+        # auxiliary function, shoudn't be called outside
+        # group the target sites with identical (column pattern, Q_i) pairs into site patterns
+        # the likelihood engine works on one representative site per pattern and weights 
+        # the contribution of each pattern by its multiplicity, so the results are the same as for the uncompressed sites
+        #   + self.pattern_sites: the representative (first) site of each pattern
+        #   + self.site_weights: the number of sites of each pattern
+        #   + self.site_index: the pattern of each site; X[...,self.site_index] expands a per-pattern array X back to all sites
+        #   + self.log_Q_patterns: the rows of self.log_Q of the representative sites
+        # identical columns of the character matrix
+        _,columns = np.unique(self.charMtrx.X,axis=1,return_inverse=True)
+        columns = columns.reshape(-1)
+        patterns = {}
+        self.pattern_sites = []
+        self.site_index = np.zeros(self.numsites,dtype=int)
+        for site in range(self.numsites):
+            key = (columns[site],self.Q[site].tobytes())
+            if key not in patterns:
+                patterns[key] = len(self.pattern_sites)
+                self.pattern_sites.append(site)
+            self.site_index[site] = patterns[key]
+        self.num_patterns = len(self.pattern_sites)
+        self.site_weights = np.bincount(self.site_index,minlength=self.num_patterns).astype(float)
+        self.log_Q_patterns = self.log_Q[self.pattern_sites]
+
+    def __build_topology__(self):
+        # auxiliary function, shoudn't be called outside
+        # build the compact array representation of self.trees that is used by all inner loops of the solver
+        # the nodes of all trees are indexed in postorder (node.idx), then 
+        #   + self.parent[i]: the parent of node i (-1 for the roots)
+        #   + self.child[i]: the first child of node i (-1 for the leaves)
+        #   + self.sibling[i]: the next sibling of node i (-1 for the last child)
+        #   + self.postorder: all nodes in postorder, tree by tree; self.roots: the root of each tree
+        #   + self.brlen: the edge-length vector (nan for the missing edge lengths)
+        #   + self.labels: the node labels
+        #   + self.multiplicity: the number of identical cells represented by each leaf (1 for the internal nodes)
+        #   + self.nodes: the treeswift node of each index
+        #   + self.anchor_index: the anchor index of each tree (see lca_lib.Anchor_index), built on demand by __anchor_index__
+        # if the solver already has an arena (see __init_arena__), it is refreshed for the new topology
+        # the treeswift objects in self.trees are only synchronized with the arrays at the API boundary (see get_tree_newick)
+        nodes = []
+        for tree in self.trees:
+            for node in tree.traverse_postorder():
+                node.idx = len(nodes)
+                nodes.append(node)
+        self.num_nodes = len(nodes)
+        self.parent = np.full(self.num_nodes,-1,dtype=int)
+        self.child = np.full(self.num_nodes,-1,dtype=int)
+        self.sibling = np.full(self.num_nodes,-1,dtype=int)
+        for node in nodes:
+            if not node.is_root():
+                self.parent[node.idx] = node.parent.idx
+            C = node.children
+            if len(C) > 0:
+                self.child[node.idx] = C[0].idx
+            for c,c_next in zip(C[:-1],C[1:]):
+                self.sibling[c.idx] = c_next.idx
+        self.postorder = np.arange(self.num_nodes)
+        self.roots = np.array([tree.root.idx for tree in self.trees],dtype=int)
+        self.brlen = np.array([np.nan if node.edge_length is None else node.edge_length for node in nodes],dtype=float)
+        self.labels = [node.label for node in nodes]
+        self.multiplicity = np.array([self.leaf_weights.get(node.label,1) if node.is_leaf() else 1 for node in nodes],dtype=float)
+        self.mark_fixed = np.zeros(self.num_nodes,dtype=bool)
+        self.nodes = nodes
+        self.anchor_index = None
+        if hasattr(self,'L0'): # the arena belongs to the previous topology: recompute the az-partition and drop the cached inside pass
+            self.in_state = None
+            self.az_partition()
+
+    def __anchor_index__(self):
+        # auxiliary function, shoudn't be called outside
+        # the anchor index of each tree; it is kept up to date by move_subtrees
+        if self.anchor_index is None:
+            self.anchor_index = [Anchor_index(tree) for tree in self.trees]
+        return self.anchor_index
+
+    def __children__(self,i):
+        # auxiliary function, shoudn't be called outside
+        # the list of the children of node i in the array representation
+        C = []
+        c = self.child[i]
+        while c != -1:
+            C.append(c)
+            c = self.sibling[c]
+        return C
+
+    def __sync_trees__(self):
+        # auxiliary function, shoudn't be called outside
+        # write the edge-length vector back to the treeswift objects in self.trees
+        for tree in self.trees:
+            for node in tree.traverse_postorder():
+                d = self.brlen[node.idx]
+                node.edge_length = None if np.isnan(d) else float(d)
 
     def get_tree_newick(self):
+        self.__sync_trees__()
         return [tree.newick() for tree in self.trees]
 
     def get_params(self):
         return {'phi':self.params.phi,'nu':self.params.nu}
 
+    def __node_arrays__(self):
+        # auxiliary function, shoudn't be called outside
+        # the names of the per-node arrays whose rows move with the nodes when they are re-indexed (see __reindex_subtree__)
+        # the other buffers of the arena are overwritten by every pass that reads them
+        names = ['brlen','multiplicity','mark_fixed']
+        if hasattr(self,'L0'):
+            names += ['alpha','log_q','is_missing','L0','L1','llh_terms','in_dirty']
+        return names
+
+    def __reindex_subtree__(self,v):
+        # auxiliary function, shoudn't be called outside
+        # restore the postorder indexing of the nodes after the topology below node v has changed (the node set is the same):
+        # the subtree of v occupies the block of indices that ends at v, which is reassigned in postorder;
+        # the indices outside of the block do not change, and the per-node arrays are permuted with the nodes
+        # output: the old index of each node of the block, in the new order
+        nodes = list(self.nodes[v].traverse_postorder())
+        first = v - len(nodes) + 1
+        old = np.array([node.idx for node in nodes],dtype=int)
+        for name in self.__node_arrays__():
+            A = getattr(self,name)
+            A[first:v+1] = A[old]
+        if hasattr(self,'L0') and self.in_state is not None:
+            self.in_state[0][first:v+1] = self.in_state[0][old]
+        self.labels[first:v+1] = [self.labels[i] for i in old]
+        for k,node in enumerate(nodes):
+            node.idx = first + k
+            self.nodes[node.idx] = node
+        for node in nodes:
+            i = node.idx
+            if node is not self.nodes[v]:
+                self.parent[i] = node.parent.idx
+            C = node.children
+            self.child[i] = C[0].idx if len(C) > 0 else -1
+            for c,c_next in zip(C,C[1:]+[None]):
+                self.sibling[c.idx] = -1 if c_next is None else c_next.idx
+        return old
+
+    def __lca__(self,nodes):
+        # auxiliary function, shoudn't be called outside
+        # the lowest common ancestor of the input nodes; -1 if they are not in the same tree
+        path = [nodes[0]]
+        while self.parent[path[-1]] != -1:
+            path.append(self.parent[path[-1]])
+        pos = {a:k for k,a in enumerate(path)}
+        k = 0
+        for i in nodes[1:]:
+            while i != -1 and i not in pos:
+                i = self.parent[i]
+            if i == -1:
+                return -1
+            k = max(k,pos[i])
+        return path[k]
+
+    def move_subtrees(self,moves):
+    # Purpose: rearrange the trees in place, keeping all the precomputed data (character matrix, priors, site patterns, arena)
+    # moves is a list of moves (x,y) or (x,y,k) of node indices, applied in the given order: the node x, with its subtree and
+    # the branch above it, is detached from its parent and attached as the k-th child of y (default: the last child)
+    # all moves must stay within one tree, and y must not be in the subtree of x
+    # the nodes are re-indexed in postorder (only the subtree that contains all moves is renumbered), and the az-partition
+    # is updated and the inside pass is marked dirty along the modified paths, so the next lineage_llh is incremental
+    # Output: the list of the moves (in the new indices) that undo the rearrangement exactly
+        touched = [self.parent[x] for x,*_ in moves] + [y for _,y,*_ in moves]
+        top = self.__lca__(touched)
+        if top == -1:
+            raise ValueError("move_subtrees: the moves must stay within one tree")
+        touched = [self.nodes[i] for i in set(touched)]
+        undo = []
+        for x,y,*k in moves:
+            x_node,y_node = self.nodes[x],self.nodes[y]
+            p_node = x_node.parent
+            undo.append((x_node,p_node,p_node.children.index(x_node)))
+            p_node.remove_child(x_node)
+            y_node.children.insert(k[0] if len(k) > 0 else len(y_node.children),x_node)
+            x_node.parent = y_node
+        self.__reindex_subtree__(top)
+        if self.anchor_index is not None: # the nodes in postorder, as required by Anchor_index.update
+            self.anchor_index[np.searchsorted(self.roots,top)].update(sorted(touched,key=lambda node: node.idx))
+        # the nodes whose children changed; the subtrees below them are intact, but the llh terms 
+        # of the moved nodes depend on the alpha of their new parents
+        touched = [node.idx for node in touched]
+        if hasattr(self,'L0'):
+            self.update_az_partition(touched)
+            self.mark_dirty([x_node.idx for x_node,_,_ in undo])
+        return [(x_node.idx,p_node.idx,k) for x_node,p_node,k in reversed(undo)]
+
+    def nni(self,u,c,w=None):
+    # Purpose: the NNI around the branch above the internal node u (not a root) that swaps the child c of u
+    # with the sibling w of u (default: the first sibling of u), in place (see move_subtrees)
+    # Output: the list of the moves that undo the NNI, to be passed to move_subtrees
+        v = self.parent[u]
+        if w is None:
+            w = next(x for x in self.__children__(v) if x != u)
+        return self.move_subtrees([(c,v),(w,u)])
+
+    def __ultrametric_rows__(self,free,col,const_len):
+        # auxiliary function, shoudn't be called outside
+        # the rows of the ultrametric constraints in sparse form: for each internal node, the two paths from (the edges above)
+        # its children down to a leaf have the same length; the same holds for the paths from the roots of all trees
+        # each path follows the child with the fewest edges to a leaf, so a row has O(log n) entries instead of O(N)
+        # free: the mask of the edges that are variables; col: the column of each variable edge
+        # const_len: the constant length of each edge that is not a variable (0 if unknown)
+        # output: a list of rows (cols,vals,b) that represent sum(vals*x[cols]) = b
+        nxt = np.full(self.num_nodes,-1,dtype=int)
+        hops = np.zeros(self.num_nodes,dtype=int)
+        const = np.zeros(self.num_nodes)
+        for i in self.postorder:
+            C = self.__children__(i)
+            if len(C) > 0:
+                nxt[i] = min(C,key=lambda c: hops[c])
+                hops[i] = hops[nxt[i]] + 1
+                const[i] = const[nxt[i]]
+            const[i] += const_len[i]
+        def __path__(i):
+            cols = []
+            while i != -1:
+                if free[i]:
+                    cols.append(col[i])
+                i = nxt[i]
+            return cols
+        def __row__(u,v):
+            p,q = __path__(u),__path__(v)
+            return p+q,[1.]*len(p)+[-1.]*len(q),const[v]-const[u]
+        rows = []
+        for i in self.postorder:
+            if self.child[i] != -1:
+                c1,c2 = self.__children__(i)
+                rows.append(__row__(c1,c2))
+        for r in self.roots[1:]:
+            rows.append(__row__(self.roots[0],r))
+        return rows
+
     def ultrametric_constr(self):
+        # the ultrametric constraints M @ x = 0 as a sparse (CSR) matrix, where x = [brlen of all nodes] + [other params]
         N = len(self.ini_all())
-        M = []
-        idx = 0
-        for tree in self.trees: 
-            for node in tree.traverse_postorder():
-                if node.is_leaf():
-                    node.constraint = [0.]*N
-                else:
-                    c1,c2 = node.children
-                    m = [x-y for (x,y) in zip(c1.constraint,c2.constraint)]
-                    M.append(m)
-                    node.constraint = c1.constraint
-                node.constraint[idx] = 1
-                idx += 1
-        for tree in self.trees[1:]:
-            m = [x-y for (x,y) in zip(self.trees[0].root.constraint,tree.root.constraint)]
-            M.append(m)
-        return M
-
-    def score_tree(self,strategy={'ultra_constr':False,'fixed_phi':None,'fixed_nu':None,'fixed_brlen':None}):
+        rows = self.__ultrametric_rows__(np.full(self.num_nodes,True),np.arange(self.num_nodes),np.zeros(self.num_nodes))
+        indptr = np.cumsum([0]+[len(cols) for cols,_,_ in rows])
+        indices = [c for cols,_,_ in rows for c in cols]
+        data = [x for _,vals,_ in rows for x in vals]
+        return csr_matrix((data,indices,indptr),shape=(len(rows),N))
+
+    def score_tree(self,strategy={'ultra_constr':False,'fixed_phi':None,'fixed_nu':None,'fixed_brlen':None,'accelerate':False}):
         ultra_constr = strategy['ultra_constr']
         fixed_phi = strategy['fixed_phi']
         fixed_nu = strategy['fixed_nu']
         fixed_brlen = strategy['fixed_brlen']
-        nllh,status = self.optimize(initials=1,verbose=-1,ultra_constr=ultra_constr,fixed_phi=fixed_phi,fixed_nu=fixed_nu,fixed_brlen=fixed_brlen)
+        accelerate = strategy['accelerate'] if 'accelerate' in strategy else False
+        keep_topology = strategy['keep_topology'] if 'keep_topology' in strategy else False
+        nllh,status = self.optimize(initials=1,verbose=-1,ultra_constr=ultra_constr,fixed_phi=fixed_phi,fixed_nu=fixed_nu,fixed_brlen=fixed_brlen,accelerate=accelerate,keep_topology=keep_topology)
         score = None if nllh is None else -nllh
         #if score is None:
         #    print("Fatal error: failed to score tree " + self.get_tree_newick() + ". Optimization status: " + status)
         return score,status
 
+    def __init_arena__(self):
+        # auxiliary function, shoudn't be called outside
+        # set up the storage arena of the solver: contiguous arrays of shape (num_nodes,num_patterns) 
+        # holding the per-node, per-site-pattern state, where row i belongs to node i of the array representation 
+        # the buffers are reused as long as the number of nodes does not change,
+        # so they are allocated once and shared by all iterations and all initial points of optimize 
+        # output: True if the buffers have been (re)allocated, False if they are reused
+        if hasattr(self,'L0') and self.L0.shape[0] == self.num_nodes:
+            return False
+        shape = (self.num_nodes,self.num_patterns)
+        self.alpha = np.zeros(shape,dtype=int) # 0 for 'z', -1 for '?', otherwise the alpha state
+        self.log_q = np.zeros(shape) # log of the prior of the alpha state (0 if the branch is not an alpha-branch)
+        self.is_missing = np.zeros(shape,dtype=bool) # the missing ('?') entries of the leaves
+        self.L0 = np.zeros(shape)
+        self.L1 = np.zeros(shape)
+        self.llh_terms = np.zeros(self.num_nodes) # the contribution of each node to lineage_llh
+        # dirty-node tracking of the inside pass (see __dirty_nodes__)
+        self.in_dirty = np.ones(self.num_nodes,dtype=bool)
+        self.in_state = None
+        return True
+
+    def __az_node__(self,i):
+        # auxiliary function, shoudn't be called outside
+        # compute the alpha of node i for all site patterns from the character matrix (leaf) 
+        # or from the alpha of its children (internal node) 
+        if self.child[i] == -1:
+            c = self.charMtrx.X[self.charMtrx.cell_index[self.labels[i]],self.pattern_sites]
+            self.is_missing[i] = (c == MISSING)
+            self.alpha[i] = np.where(c == MISSING,-1,c)
+        else:
+            C = self.alpha[self.__children__(i)]
+            hi = C.max(axis=0)
+            lo = np.where(C > 0,C,hi).min(axis=0) # the smallest alpha state among the children
+            is_z = (C == 0).any(axis=0) | ((hi > 0) & (lo != hi))
+            self.alpha[i] = np.where(is_z,0,np.where(hi > 0,hi,-1))
+        alpha = self.alpha[i]
+        self.log_q[i] = np.where(alpha > 0,self.log_Q_patterns[np.arange(self.num_patterns),np.maximum(alpha,0)],0)
+
     def az_partition(self):
     # Purpose: partition the tree into edge-distjoint alpha-clades and z-branches
-    # Note: there is a different partition for each target-site
-    # Output: annotate each node of the tree by node.alpha
-        # z-branches are given tag 'z'
+    # Note: there is a different partition for each target-site (computed once per site pattern)
+    # Output: fill the row i of self.alpha for each node i of the tree
+        # z-branches are given tag 0 (i.e. 'z') 
         # each of other branches is given a tag 
         # alpha where alpha is the alpha-tree it belongs to
-        for tree in self.trees:
-            for node in tree.traverse_postorder():
-                if node.is_leaf():
-                    node.alpha = [None]*self.numsites
-                    for site in range(self.numsites):
-                        if self.charMtrx[node.label][site] == 0:
-                            node.alpha[site] = 'z'
-                        elif self.charMtrx[node.label][site] == -1:   
-                            node.alpha[site] = '?' 
-                        else:
-                            node.alpha[site] = self.charMtrx[node.label][site]
-                else:
-                    C = node.children
-                    node.alpha = [None]*self.numsites
-                    for site in range(self.numsites):
-                        S = set(c.alpha[site] for c in C)
-                        R = S-set(['z','?',-1])
-                        if 'z' in S or len(R)>1:
-                            node.alpha[site] = 'z'
-                        elif len(R) == 1:
-                            node.alpha[site] = list(R)[0]    
-                        else:
-                            node.alpha[site] = "?"
+        # branches that are entirely masked are given tag -1 (i.e. '?')
+        self.__init_arena__()
+        for i in self.postorder:
+            self.__az_node__(i)
+        self.in_dirty[:] = True
+
+    def update_az_partition(self,nodes):
+    # Purpose: recompute the az-partition after a local topology change (e.g. an NNI) 
+    # that modified the children of the input nodes, without redoing the whole tree
+    # assume az_partition has been performed before the change
+    # only the input nodes and their ancestors are recomputed; an ancestor is only 
+    # revisited if the alpha of one of its children has changed
+    # Output: the set of the nodes whose alpha has changed
+        def __depth__(i):
+            h = 0
+            while self.parent[i] != -1:
+                i = self.parent[i]
+                h += 1
+            return h
+        pending = {i:__depth__(i) for i in nodes}
+        changed = set()
+        while len(pending) > 0:
+            i = max(pending,key=pending.get) # the deepest pending node
+            h = pending.pop(i)
+            old_alpha = self.alpha[i].copy()
+            self.__az_node__(i)
+            if not np.array_equal(old_alpha,self.alpha[i]):
+                changed.add(i)
+                if self.parent[i] != -1:
+                    pending[self.parent[i]] = h-1
+        # the inside llh of the input nodes changes with their children; the llh terms of the children 
+        # of a changed node depend on its alpha
+        self.mark_dirty(nodes)
+        for i in changed:
+            self.mark_dirty(self.__children__(i))
+        return changed
+
+    def mark_dirty(self,nodes):
+    # Purpose: mark the input nodes and all their ancestors, so that the next inside pass recomputes them
+    # must be called after any change of the tree that is not a change of brlen, phi, or nu (these are detected automatically), 
+    # e.g. a change of the children of a node; a marked node always has all of its ancestors marked
+        for i in nodes:
+            while i != -1 and not self.in_dirty[i]:
+                self.in_dirty[i] = True
+                i = self.parent[i]
+
+    def __dirty_nodes__(self):
+        # auxiliary function, shoudn't be called outside
+        # the nodes whose inside llh must be recomputed, in postorder: the nodes marked by mark_dirty, 
+        # the nodes whose branch length changed since the last inside pass, and all of their ancestors (all nodes if phi or nu changed)
+        # the marks are cleared, so the caller must recompute all the returned nodes;
+        # a local change (e.g. an NNI with fixed parameters) thus costs O(depth x sites) instead of O(n x sites)
+        phi = self.params.phi
+        nu = self.params.nu
+        if self.in_state is None or self.in_state[1] != phi or self.in_state[2] != nu:
+            self.in_dirty[:] = True
+        else:
+            brlen = self.in_state[0]
+            same = (self.brlen == brlen) | (np.isnan(self.brlen) & np.isnan(brlen))
+            self.mark_dirty(np.nonzero(~same)[0])
+        self.in_state = (self.brlen.copy(),phi,nu)
+        nodes = self.postorder[self.in_dirty[self.postorder]]
+        self.in_dirty[:] = False
+        return nodes
     
     def lineage_llh(self):
         # assume az_partition has been performed so
-        # each node has the attribute node.alpha
+        # the arena holds the alpha of each node
+        # L0 and L1 of each node i are numpy vectors over all site patterns, stored in the rows i of self.L0 and self.L1
+        # only the dirty nodes are recomputed (see __dirty_nodes__); the llh is the sum of the cached terms of all nodes
         phi = self.params.phi
         nu = self.params.nu
-        llh = [0]*self.numsites
-        for tree in self.trees:
-            for node in tree.traverse_postorder():
-                p = exp(-node.edge_length)
-                node.L0 = [0]*self.numsites # L0 and L1 are stored in log-scale
-                node.L1 = [0]*self.numsites
-                for site in range(self.numsites):    
-                    if node.alpha[site] != 'z':
-                        q = self.Q[site][node.alpha[site]] if node.alpha[site] != "?" else 1.0
-                        if node.is_leaf():
-                            if node.alpha[site] == "?":         
-                                masked_llh = log(1-(1-phi)*p**nu) if (1-(1-phi)*p**nu)>0 else min_llh
-                                node.L0[site] = node.L1[site] = masked_llh
-                            else:    
-                                node.L0[site] = nu*(-node.edge_length) + log(1-p) + log(q) + log(1-phi) if (1-p)*q*(1-phi)>0 else min_llh
-                                node.L1[site] = nu*(-node.edge_length) + log(1-phi)
-                        else:
-                            C = node.children
-                            l0 = l1 = 0
-                            for c in C:
-                                l0 += c.L0[site]
-                                l1 += c.L1[site]
-                            #L0 = exp(l0+(nu+1)*(-node.edge_length)) + exp(l1 + log(1-p)+log(q) + nu*(-node.edge_length)) + (1-p**nu)*int(node.alpha[site]=="?")   
-                            L0 = exp(l0+(nu+1)*(-node.edge_length)) + q*(1-p)*exp(l1 + nu*(-node.edge_length)) + (1-p**nu)*int(node.alpha[site]=="?")   
-                            L1 = exp(l1+nu*(-node.edge_length)) + (1-p**nu)*int(node.alpha[site]=="?")
-                            node.L0[site] = min_llh if L0==0 else log(L0)
-                            node.L1[site] = min_llh if L1==0 else log(L1)
-                                
-                        if node.is_root() or node.parent.alpha[site] == 'z':
-                            llh[site] += node.L0[site]
-                    else:
-                        llh[site] += (-node.edge_length*(1+nu) + int(node.is_leaf())*log(1-phi))
-        return sum(llh)         
+        for i in self.__dirty_nodes__():
+            d = self.brlen[i]
+            p = exp(-d)
+            is_z = self.alpha[i] == 0
+            is_masked = self.alpha[i] == -1
+            is_leaf = self.child[i] == -1
+            # L0 and L1 are stored in log-scale
+            # a leaf that represents k identical cells is observed (resp. dropped out) in all of them
+            k = self.multiplicity[i]
+            if is_leaf:
+                masked_llh = pseudo_log(1-(1-phi**k)*p**nu)
+                self.L0[i] = np.where(is_masked,masked_llh,nu*(-d) + pseudo_log(1-p) + self.log_q[i] + k*pseudo_log(1-phi))
+                self.L1[i] = np.where(is_masked,masked_llh,nu*(-d) + k*pseudo_log(1-phi))
+            else:
+                C = self.__children__(i)
+                l0 = self.L0[C].sum(axis=0)
+                l1 = self.L1[C].sum(axis=0)
+                self.L0[i] = np.logaddexp(l0 + (nu+1)*(-d),l1 + pseudo_log(1-p) + self.log_q[i] + nu*(-d))
+                self.L1[i] = l1 + nu*(-d)
+                self.L0[i][is_masked] = np.logaddexp(self.L0[i][is_masked],pseudo_log(1-p**nu))
+                self.L1[i][is_masked] = np.logaddexp(self.L1[i][is_masked],pseudo_log(1-p**nu))
+            is_top = np.full(self.num_patterns,True) if self.parent[i] == -1 else (self.alpha[self.parent[i]] == 0)
+            self.llh_terms[i] = np.dot(self.site_weights,np.where(is_z,-d*(1+nu) + int(is_leaf)*k*pseudo_log(1-phi),np.where(is_top,self.L0[i],0)))
+        return np.sum(self.llh_terms)
+
+    def lineage_llh_grad(self):
+        # exact gradient of lineage_llh with respect to x = [brlen of all nodes] + [nu,phi]
+        # assume lineage_llh has just been computed with the current parameters,
+        # so L0 and L1 of all nodes in the arena are up to date
+        # reverse-mode pass: G0 and G1 hold the adjoints of L0 and L1 (d llh / d L0[i], d llh / d L1[i]),
+        # which are propagated from the top nodes down to the leaves (preorder)
+        phi = self.params.phi
+        nu = self.params.nu
+        grad = np.zeros(self.num_edges+2)
+        G0 = np.zeros((self.num_nodes,self.num_patterns))
+        G1 = np.zeros((self.num_nodes,self.num_patterns))
+        w = self.site_weights
+        for i in self.postorder[::-1]:
+            d = self.brlen[i]
+            p = exp(-d)
+            is_z = self.alpha[i] == 0
+            is_masked = self.alpha[i] == -1
+            is_leaf = self.child[i] == -1
+            k = self.multiplicity[i]
+            is_top = np.full(self.num_patterns,True) if self.parent[i] == -1 else (self.alpha[self.parent[i]] == 0)
+            # the z-sites contribute -d*(1+nu) + k*log(1-phi) directly
+            wz = np.dot(w,is_z)
+            grad[i] -= wz*(1+nu)
+            grad[-2] -= wz*d
+            if is_leaf:
+                grad[-1] -= wz*k/(1-phi)
+            G0[i] += np.where(is_top & ~is_z,w,0)
+            g0 = np.where(is_z,0,G0[i])
+            g1 = np.where(is_z,0,G1[i])
+            if is_leaf:
+                # masked: L0 = L1 = log(1-(1-phi^k)p^nu)
+                pnu = p**nu
+                denom = 1-(1-phi**k)*pnu
+                gm = np.sum((g0+g1)[is_masked])
+                if gm != 0:
+                    grad[i] += gm*(1-phi**k)*nu*pnu/denom
+                    grad[-2] += gm*(1-phi**k)*d*pnu/denom
+                    grad[-1] += gm*k*phi**(k-1)*pnu/denom
+                # observed: L0 = -nu*d + log(1-p) + log_q + k*log(1-phi), L1 = -nu*d + k*log(1-phi)
+                ga = np.sum(g0[~is_masked])
+                gb = np.sum(g1[~is_masked])
+                grad[i] += ga*(p/(1-p)-nu) - gb*nu
+                grad[-2] -= (ga+gb)*d
+                grad[-1] -= (ga+gb)*k/(1-phi)
+            else:
+                C = self.__children__(i)
+                l0 = self.L0[C].sum(axis=0)
+                l1 = self.L1[C].sum(axis=0)
+                # L0 = logaddexp(a,b[,m]) and L1 = logaddexp(c[,m]) where
+                # a = l0 - (nu+1)d, b = l1 + log(1-p) + log_q - nu*d, c = l1 - nu*d and m = log(1-p^nu) for the masked sites
+                a = l0 + (nu+1)*(-d)
+                b = l1 + pseudo_log(1-p) + self.log_q[i] + nu*(-d)
+                c = l1 + nu*(-d)
+                m = pseudo_log(1-p**nu)
+                with np.errstate(invalid='ignore'):
+                    wa = np.nan_to_num(np.exp(a-self.L0[i]))
+                    wb = np.nan_to_num(np.exp(b-self.L0[i]))
+                    wc = np.where(is_masked,np.nan_to_num(np.exp(c-self.L1[i])),1)
+                    wm0 = np.where(is_masked,np.nan_to_num(np.exp(m-self.L0[i])),0)
+                    wm1 = np.where(is_masked,np.nan_to_num(np.exp(m-self.L1[i])),0)
+                ga = g0*wa
+                gb = g0*wb
+                gc = g1*wc
+                gm = np.sum(g0*wm0 + g1*wm1)
+                G0[C] += ga
+                G1[C] += gb + gc
+                grad[i] += np.sum(ga)*(-(nu+1)) + np.sum(gb)*(p/(1-p)-nu) - np.sum(gc)*nu
+                grad[-2] -= np.sum(ga+gb+gc)*d
+                if gm != 0:
+                    grad[i] += gm*nu*p**nu/(1-p**nu)
+                    grad[-2] += gm*d*p**nu/(1-p**nu)
+        return grad
 
     def ini_brlens(self):
         x = [random() * (self.dmax/2 - 2*self.dmin) + 2*self.dmin for i in range(self.num_edges)]        
-        idx = 0
-        for tree in self.trees:
-            for node in tree.traverse_postorder():
-                if node.edge_length is not None:
-                    x[idx] = max(2*self.dmin,node.edge_length)
-                idx += 1 
+        for i in self.postorder:
+            if not np.isnan(self.brlen[i]):
+                x[i] = max(2*self.dmin,self.brlen[i])
         return x    
 
     def ini_nu(self,fixed_nu=None):
@@ -192,11 +576,7 @@ class ML_solver(Virtual_solver):
         return bounds
 
     def x2brlen(self,x):
-        i = 0
-        for tree in self.trees:
-            for node in tree.traverse_postorder():
-                node.edge_length = x[i]
-                i += 1
+        self.brlen[:] = x[:self.num_edges]
 
     def x2nu(self,x,fixed_nu=None):
         self.params.nu = x[self.num_edges] if fixed_nu is None else fixed_nu
@@ -212,13 +592,84 @@ class ML_solver(Virtual_solver):
     def __llh__(self):
         return self.lineage_llh()
 
+    def __has_llh_grad__(self):
+        # auxiliary function, shoudn't be called outside
+        return type(self).__llh__ is ML_solver.__llh__ and type(self).lineage_llh is ML_solver.lineage_llh
+
     def negative_llh(self):
         self.az_partition()
         return -self.__llh__()
 
-    def optimize(self,initials=20,fixed_phi=None,fixed_nu=None,fixed_brlen=None,verbose=1,max_trials=100,random_seeds=None,ultra_constr=False):
+    def __optimize_initial__(self,rep,randseed,brlen_ini,fixed_phi=None,fixed_nu=None,verbose=1,ultra_constr=False,accelerate=False):
+        # auxiliary function, shoudn't be called outside
+        # run the optimization from the initial point rep (identified by randseed) of self.optimize
+        # output: the tuple (nllh,rep,params,trees,status,brlen) of the result, or None if the optimization failed
+        if verbose >= 0:
+            print("Initial point " + str(rep+1) + ". Random seed: " + str(randseed))
+        if verbose >= 0:
+            if ultra_constr:
+                print("Numerical optimization started with ultrametric constraint (default)")
+            else:      
+                print("Numerical optimization started without ultrametric constraint [deprecated]")
+        self.brlen[:] = brlen_ini
+        nllh,status = self.optimize_one(randseed,fixed_phi=fixed_phi,fixed_nu=fixed_nu,verbose=verbose,ultra_constr=ultra_constr,accelerate=accelerate)
+        if nllh is None:
+            if verbose >= 0:
+                print("Fatal: failed to optimize using initial point " + str(rep+1))    
+            return None
+        return self.__initial_result__(nllh,rep,status,verbose=verbose)
+
+    def __collapsible__(self):
+        # auxiliary function, shoudn't be called outside
+        # the mask of the branches that are collapsed by optimize if they are too short (see __initial_result__): the internal branches
+        return (self.parent != -1) & (self.child != -1)
+
+    def __initial_result__(self,nllh,rep,status,verbose=1):
+        # auxiliary function, shoudn't be called outside
+        # pack the current solution of the initial point rep into the result tuple (nllh,rep,params,trees,status,brlen) of self.optimize
+        # trees is None if no branch is collapsed, so that the solver keeps its own trees and only takes brlen
+        if verbose >= 0:
+            print("Optimal point found for initial point " + str(rep+1))
+            #self.show_params()
+        # remove zero-length branches (a missing branch length counts as 0, as in collapse_short_branches)
+        brlen = self.brlen.copy()
+        is_short = ~(brlen > self.dmin*0.01)
+        brlen[is_short & (self.parent == -1)] = np.nan
+        processed_trees = None
+        if np.any(is_short & self.__collapsible__()):
+            processed_trees = []
+            for tree_str in self.get_tree_newick():
+                tree_copy = read_tree_newick(tree_str)
+                tree_copy.collapse_short_branches(self.dmin*0.01)
+                processed_trees.append(tree_copy.newick())
+        return (nllh,rep,deepcopy(self.params),processed_trees,status,brlen)
+
+    def __run_tasks__(self,tasks,options,threads=1):
+        # auxiliary function, shoudn't be called outside
+        # run a list of tasks (method name, args, kwargs), in a process pool if threads > 1
+        # the options (fixed_phi, fixed_nu, verbose, ultra_constr) of self.optimize are shared by all tasks
+        # the solver is handed to the workers once by the pool initializer; each task only sends its own arguments
+        if threads > 1 and len(tasks) > 1:
+            with Pool(processes=min(threads,len(tasks)),initializer=__multistart_init__,initargs=(self,options)) as pool:
+                return pool.map(__multistart_run__,tasks)
+        return [getattr(self,method)(*args,**kwargs,**options) for (method,args,kwargs) in tasks]
+
+    def __optimize_initials__(self,reps,randseeds,brlen_ini,options,threads=1,race_iters=0,race_margin=0):
+        # auxiliary function, shoudn't be called outside
+        # run all initial points to convergence; the results are in the same order as reps
+        # racing (race_iters > 0) needs an iterative optimizer that can be stopped and resumed, so it is only supported by EM_solver
+        tasks = [('__optimize_initial__',(rep,randseed,brlen_ini),{}) for (rep,randseed) in zip(reps,randseeds)]
+        return self.__run_tasks__(tasks,options,threads=threads)
+
+    def optimize(self,initials=20,fixed_phi=None,fixed_nu=None,fixed_brlen=None,verbose=1,max_trials=100,random_seeds=None,ultra_constr=False,threads=1,race_iters=0,race_margin=1e-3,accelerate=False,keep_topology=False):
     # random_seeds can either be a single number or a list of intergers where len(random_seeds) = initials
     # verbose level: 1 --> show all messages; 0 --> show minimal messages; -1 --> completely silent
+    # threads: the number of processes that run the initial points in parallel; the result is the same as with threads=1
+    # race_iters, race_margin: if race_iters > 0, all initial points first run race_iters iterations, then the ones whose nllh
+    #   trails the best by more than race_margin (relative) are dropped and only the others continue to convergence (EM_solver only)
+    # accelerate: accelerate the EM algorithm by SQUAREM (EM_solver only, see EM_solver.EM_optimization)
+    # keep_topology: never rebuild self.trees, i.e. the short branches are not collapsed and only the branch lengths are updated;
+    #   used by the solvers whose trees are changed in place (see Topology_search.apply_nni), as the node indices stay valid
     # fixed_brlen is a list of t dictionaries, where t is the number of trees in self.trees, each maps a tuple (a,b) to a number. Each pair a, b is a tuple of two leaf nodes whose LCA define the node for the branch above it to be fixed.
         results = []
         all_failed = True
@@ -243,45 +694,27 @@ class ML_solver(Virtual_solver):
             if verbose >= 0:
                 print("Fatal: incorrect random_seeds type provided")        
             return None
+        # read in fixed_brlen and mark the tree nodes
+        self.mark_fixed[:] = False
+        for t,tree in enumerate(self.trees):
+            if fixed_brlen is None:
+                continue
+            fixed_nodes = self.__anchor_index__()[t].find(list(fixed_brlen[t].keys()))        
+            for i,(a,b) in enumerate(fixed_brlen[t]):
+                u = fixed_nodes[i]
+                self.brlen[u.idx] = fixed_brlen[t][(a,b)]
+                self.mark_fixed[u.idx] = True
+        # all initial points start from the same branch lengths, so they are independent and can run in any order
+        brlen_ini = self.brlen.copy()
+        options = {'fixed_phi':fixed_phi,'fixed_nu':fixed_nu,'verbose':verbose,'ultra_constr':ultra_constr,'accelerate':accelerate}
         while all_failed and all_trials < max_trials:
             if verbose > 0:
                 print("Optimization start with " + str(initials) + " initials")
-            for rep in range(initials):
-                randseed = rseeds[rep] + all_trials
-                if verbose >= 0:
-                    print("Initial point " + str(rep+1) + ". Random seed: " + str(randseed))
-                if verbose >= 0:
-                    if ultra_constr:
-                        print("Numerical optimization started with ultrametric constraint (default)")
-                    else:      
-                        print("Numerical optimization started without ultrametric constraint [deprecated]")
-                # read in fixed_brlen and mark the tree nodes
-                for t,tree in enumerate(self.trees):
-                    for node in tree.traverse_postorder():
-                        node.mark_fixed=False
-                    if fixed_brlen is None:
-                        continue
-                    fixed_nodes = find_LCAs(tree,list(fixed_brlen[t].keys()))        
-                    for i,(a,b) in enumerate(fixed_brlen[t]):
-                        u = fixed_nodes[i]
-                        u.edge_length = fixed_brlen[t][(a,b)]
-                        u.mark_fixed = True
-                nllh,status = self.optimize_one(randseed,fixed_phi=fixed_phi,fixed_nu=fixed_nu,verbose=verbose,ultra_constr=ultra_constr)
-                
-                if nllh is not None:
+            rep_results = self.__optimize_initials__(list(range(initials)),[rseeds[rep] + all_trials for rep in range(initials)],brlen_ini,options,threads=threads,race_iters=race_iters,race_margin=race_margin)
+            for result in rep_results:
+                if result is not None:
                     all_failed = False
-                    if verbose >= 0:
-                        print("Optimal point found for initial point " + str(rep+1))
-                        #self.show_params()
-                    # remove zero-length branches
-                    processed_trees = []
-                    for tree in self.trees:
-                        tree_copy = read_tree_newick(tree.newick())
-                        tree_copy.collapse_short_branches(self.dmin*0.01)
-                        processed_trees.append(tree_copy.newick())
-                    results.append((nllh,rep,deepcopy(self.params),processed_trees,status))
-                elif verbose >= 0:
-                    print("Fatal: failed to optimize using initial point " + str(rep+1))    
+                    results.append(result)
             all_trials += initials    
         if all_failed:
             if verbose >= 0:
@@ -289,23 +722,42 @@ class ML_solver(Virtual_solver):
             return None
         else:    
             results.sort()
-            best_nllh,_,best_params,best_trees,status = results[0]
-            self.trees = []
-            for tree in best_trees:
-                self.trees.append(read_tree_newick(tree))
+            best_nllh,_,best_params,best_trees,status,best_brlen = results[0]
+            if best_trees is None or keep_topology: # the topology is unchanged: keep the trees, the node indices, and the arena
+                self.brlen[:] = best_brlen
+                self.mark_fixed[:] = False
+                self.__sync_trees__()
+            else:    
+                self.trees = []
+                for tree in best_trees:
+                    self.trees.append(read_tree_newick(tree))
+                self.__build_topology__()
             self.params = best_params
             if verbose >= 0:
                 print("Numerical optimization finished successfully")
             return results[0][0],status
 
-    def optimize_one(self,randseed,fixed_phi=None,fixed_nu=None,verbose=1,ultra_constr=False):
+    def optimize_one(self,randseed,fixed_phi=None,fixed_nu=None,verbose=1,ultra_constr=False,accelerate=False):
         # optimize using a specific initial point identified by the input randseed
         # verbose level: 1 --> show all messages; 0 --> show minimal messages; -1 --> completely silent
+        # accelerate is only used by EM_solver; SLSQP is not a fixed-point iteration
         warnings.filterwarnings("ignore")
         def nllh(x): 
             self.x2params(x,fixed_nu=fixed_nu,fixed_phi=fixed_phi)            
             return -self.__llh__()
         
+        def nllh_and_grad(x):
+            # the gradient reuses the inside pass of the llh evaluation
+            self.x2params(x,fixed_nu=fixed_nu,fixed_phi=fixed_phi)
+            f = -self.__llh__()
+            g = np.zeros(len(x))
+            g[:self.num_edges+2] = -self.lineage_llh_grad()
+            if fixed_nu is not None:
+                g[self.num_edges] = 0
+            if fixed_phi is not None:
+                g[self.num_edges+1] = 0
+            return f,g
+        
         seed(a=randseed)
         x0 = self.ini_all(fixed_phi=fixed_phi,fixed_nu=fixed_nu)
         self.az_partition()
@@ -314,22 +766,24 @@ class ML_solver(Virtual_solver):
 
         A = []
         b = []
-        idx = 0
-        for tree in self.trees:
-            for node in tree.traverse_postorder():
-                if node.mark_fixed:
-                    a = [0]*len(x0)
-                    a[idx] = 1
-                    A.append(a)
-                    b.append(node.edge_length)
-                idx += 1   
+        for i in self.postorder:
+            if self.mark_fixed[i]:
+                a = [0]*len(x0)
+                a[i] = 1
+                A.append(a)
+                b.append(self.brlen[i])
         if len(A) > 0:     
             constraints.append(optimize.LinearConstraint(csr_matrix(A),b,b,keep_feasible=False))
         if ultra_constr:
             M = self.ultrametric_constr()
-            constraints.append(optimize.LinearConstraint(csr_matrix(M),[0]*len(M),[0]*len(M),keep_feasible=False))
+            constraints.append(optimize.LinearConstraint(M,[0]*M.shape[0],[0]*M.shape[0],keep_feasible=False))
         disp = (verbose > 0)
-        out = optimize.minimize(nllh, x0, method="SLSQP", options={'disp':disp,'iprint':3,'maxiter':1000}, bounds=bounds,constraints=constraints)
+        # the analytic gradient only covers the lineage llh; solvers that add other terms to __llh__
+        # fall back to the finite-difference gradient of SLSQP
+        if self.__has_llh_grad__():
+            out = optimize.minimize(nllh_and_grad, x0, method="SLSQP", jac=True, options={'disp':disp,'iprint':3,'maxiter':1000}, bounds=bounds,constraints=constraints)
+        else:    
+            out = optimize.minimize(nllh, x0, method="SLSQP", options={'disp':disp,'iprint':3,'maxiter':1000}, bounds=bounds,constraints=constraints)
         if out.success:
             self.x2params(out.x,fixed_phi=fixed_phi,fixed_nu=fixed_nu)
             params = self.params
@@ -22,7 +22,7 @@ class SpaLin_solver(ML_solver):
             for node in tree.traverse_preorder():
                 if node.is_root() or not node.label in locations or not node.parent.label in locations:
                     continue
-                d = node.edge_length
+                d = self.brlen[node.idx]
                 curr_sigma = self.params.sigma*sqrt(d)
                 x,y = locations[node.label]
                 x_par,y_par = locations[node.parent.label]
@@ -5,7 +5,6 @@ from laml_libs import *
 from treeswift import *
 from laml_libs.EM_solver import EM_solver
 from copy import deepcopy
-from laml_libs.lca_lib import find_LCAs
 
 class Topology_search:
     def __init__(self,treeTopoList,solver,data={},prior={},params={},T_cooldown=20,alpha_cooldown=0.9):
@@ -134,9 +133,16 @@ class Topology_search:
     
     def __search_one__(self,strategy,maxiter=100,verbose=False,only_marked=False, checkpoint_file=None):
         # optimize branch lengths and other parameters for the starting tree
+        # the same solver is kept for the whole search: the NNI moves are applied to its trees in place (see apply_nni),
+        # so it is always scored with keep_topology (ML_solver.optimize must not rebuild its trees)
         mySolver = self.get_solver()
+        for tree,tree_obj in zip(mySolver.trees,self.treeList_obj):
+            for node,node_obj in zip(tree.traverse_postorder(),tree_obj.traverse_postorder()):
+                node.mark = getattr(node_obj,'mark',False)
+        self.mySolver = mySolver
         score_tree_strategy = deepcopy(strategy)
         score_tree_strategy['fixed_brlen'] = None
+        score_tree_strategy['keep_topology'] = True
         curr_score,status = mySolver.score_tree(strategy=score_tree_strategy)
         if verbose:
             if self.has_polytomy:
@@ -177,7 +183,7 @@ class Topology_search:
     
     def single_nni(self,curr_score,nni_iter,strategy,only_marked=False,verbose=False):
         branches = []
-        for tree in self.treeList_obj:
+        for tree in self.mySolver.trees:
             for node in tree.traverse_preorder():
                 if node.is_leaf() or node.is_root():
                     continue
@@ -197,6 +203,10 @@ class Topology_search:
     
     def apply_nni(self,u,curr_score,nni_iter,strategy):
         # apply nni [DESTRUCTIVE FUNCTION! Changes tree inside this function.]
+        # u is a node of the trees of the live solver self.mySolver; the moves are applied to the solver in place
+        # (see ML_solver.nni), and a rejected move is undone together with the branch lengths and params
+        # with local_brlen_opt, the EM solver only visits the branches next to the move (see EM_solver.optimize_local)
+        mySolver = self.mySolver
         v = u.get_parent()
         for node in v.child_nodes():
             if node != u:
@@ -207,60 +217,45 @@ class Topology_search:
         shuffle(u_children)
         score_tree_strategy = deepcopy(strategy)
         score_tree_strategy['fixed_brlen'] = None
+        score_tree_strategy['keep_topology'] = True
+        local_em = strategy['local_brlen_opt'] and isinstance(mySolver,EM_solver)
 
         if strategy['local_brlen_opt']:
             score_tree_strategy['fixed_nu'] = self.params['nu'] 
             score_tree_strategy['fixed_phi'] = self.params['phi'] 
+        if strategy['local_brlen_opt'] and not local_em:
+            # the anchors of the branches are kept by the solver (see lca_lib.Anchor_index)
             free_branches = set(u.child_nodes() + v.child_nodes() + [v])
-            fixed_branches_anchors = [[] for _ in range(len(self.treeList_obj))]
-            for t,tree in enumerate(self.treeList_obj):
-                for node in tree.traverse_postorder():
-                    if node.is_leaf():
-                        node.anchors = (node.label,node.label)
-                    else:
-                        C = node.child_nodes()
-                        a = C[0].anchors[0]
-                        b = C[-1].anchors[0]
-                        node.anchors = (a,b)
-                    if not node in free_branches:
-                        fixed_branches_anchors[t].append(node.anchors)
-            fixed_branches = [[] for _ in range(len(self.treeList_obj))]
-            for t,treeTopo in enumerate(self.treeTopoList):
-                tree = read_tree_newick(treeTopo)
-                fixed_branches[t] += find_LCAs(tree,fixed_branches_anchors[t])
-            fixed_brlen = [{} for _ in range(len(self.treeList_obj))]
-            for t,B in enumerate(fixed_branches):
-                for i,node in enumerate(B):
-                    fixed_brlen[t][fixed_branches_anchors[t][i]] = node.edge_length
+            fixed_brlen = []
+            for index in mySolver.__anchor_index__():
+                fixed_brlen.append({anchors:mySolver.brlen[node.idx] for anchors,node in index.nodes.items() if not node in free_branches})
             score_tree_strategy['fixed_brlen'] = fixed_brlen
 
+        brlen = mySolver.brlen.copy()
         for u_child in u_children:
-            u_child.set_parent(v)
-            u.remove_child(u_child)
-            v.add_child(u_child)
-
-            w.set_parent(u)
-            v.remove_child(w)
-            u.add_child(w)
-
-            mySolver = self.solver([tree.newick() for tree in self.treeList_obj],self.data,self.prior,self.params)            
-            new_score,status = mySolver.score_tree(strategy=score_tree_strategy)
+            if local_em: # the same moves as mySolver.nni
+                nllh,status,undo = mySolver.optimize_local([(u_child.idx,v.idx),(w.idx,u.idx)],ultra_constr=strategy['ultra_constr'])
+                new_score = None if nllh is None else -nllh
+                brlen_nni = mySolver.brlen.copy() # the branch lengths are reset if the local optimization failed
+            else:    
+                undo = mySolver.nni(u.idx,u_child.idx,w=w.idx)
+                brlen_nni = mySolver.brlen.copy()
+                new_score,status = mySolver.score_tree(strategy=score_tree_strategy)
             if status != "optimal" and strategy['local_brlen_opt']:
                 score_tree_strategy['fixed_brlen'] = None
-                mySolver = self.solver([tree.newick() for tree in self.treeList_obj],self.data,self.prior,self.params)            
+                mySolver.brlen[:] = brlen_nni
+                mySolver.params.phi = self.params['phi']
+                mySolver.params.nu = self.params['nu']
                 new_score,status = mySolver.score_tree(strategy=score_tree_strategy)
             if self.__accept_proposal__(curr_score,new_score,nni_iter): # accept the new tree and params                
                 self.update_from_solver(mySolver)
                 return True,new_score
             
             # Score doesn't improve --> reverse to the previous state
-            u_child.set_parent(u)
-            v.remove_child(u_child)
-            u.add_child(u_child)
-            
-            w.set_parent(v)
-            u.remove_child(w)
-            v.add_child(w)            
+            mySolver.move_subtrees(undo)
+            mySolver.brlen[:] = brlen
+            mySolver.params.phi = self.params['phi']
+            mySolver.params.nu = self.params['nu']
 
         # no move accepted
         return False,curr_score
@@ -6,10 +6,47 @@ from treeswift import *
 from laml_libs.EM_solver import EM_solver
 from laml_libs.Topology_search import Topology_search
 from copy import deepcopy
-from laml_libs.lca_lib import find_LCAs
+from laml_libs.lca_lib import Anchor_index
+from laml_libs.sequence_lib import encode_charMtrx
 from multiprocessing import Pool
 
+# the solver class and the read-only data of the worker processes of Topology_search_parallel (see __nni_init__)
+__nni_worker__ = None
+
+def __nni_init__(solver,data,prior):
+    # auxiliary function, shoudn't be called outside
+    # pool initializer: each worker keeps its own copy of the character matrix (encoded once) and the priors for the whole search
+    global __nni_worker__
+    data = dict(data)
+    data['charMtrx'] = encode_charMtrx(data['charMtrx'])
+    __nni_worker__ = (solver,data,prior)
+
+def __nni_score__(task):
+    # auxiliary function, shoudn't be called outside
+    # score a candidate topology; a task is a tuple (treeTopoList,params,score_tree_strategy) (see Topology_search_parallel.single_nni)
+    # output: the score and the status, with the optimized trees (newick strings) and params (see Topology_search.update_from_solver)
+    solver,data,prior = __nni_worker__
+    treeTopoList,params,score_tree_strategy = task
+    mySolver = solver(treeTopoList,data,prior,params)
+    score,status = mySolver.score_tree(strategy=score_tree_strategy)
+    return {'score':score,'status':status,'trees':mySolver.get_tree_newick(),'params':mySolver.get_params()}
+
 class Topology_search_parallel(Topology_search):
+    def search(self,resolve_polytomies=True,maxiter=100,verbose=False,nreps=1,strategy=DEFAULT_STRATEGY,checkpoint_file=None):
+        # one pool of workers is kept for the whole search: the workers receive the solver and the read-only data once (see __nni_init__),
+        # and each task only carries a candidate topology with the params and the strategy to score it
+        with Pool(initializer=__nni_init__,initargs=(self.solver,self.data,self.prior)) as pool:
+            self.pool = pool
+            try:
+                return super(Topology_search_parallel,self).search(resolve_polytomies=resolve_polytomies,maxiter=maxiter,verbose=verbose,nreps=nreps,strategy=strategy,checkpoint_file=checkpoint_file)
+            finally:
+                self.pool = None
+
+    def __search_one__(self,strategy,maxiter=100,verbose=False,only_marked=False,checkpoint_file=None):
+        # the anchor index of self.treeList_obj is kept for the whole search; the accepted nni moves update it in place (see single_nni)
+        self.anchor_index = [Anchor_index(tree) for tree in self.treeList_obj]
+        return super(Topology_search_parallel,self).__search_one__(strategy,maxiter=maxiter,verbose=verbose,only_marked=only_marked,checkpoint_file=checkpoint_file)
+
     def single_nni(self,curr_score,nni_iter,strategy,only_marked=False):
         all_nni_moves = self.list_all_nni(strategy,only_marked=only_marked)
         N = len(all_nni_moves)
@@ -22,21 +59,23 @@ class Topology_search_parallel(Topology_search):
         curr_queue = all_nni_moves
         while True:
             subset_nni_moves = curr_queue[curr_start_idx:curr_end_idx]
-            with Pool() as pool:
-                nni_results = pool.map(self.apply_nni,subset_nni_moves) 
+            nni_results = self.__score_nni__([(nwk_strs,self.params,score_tree_strategy) for (nwk_strs,score_tree_strategy,_) in subset_nni_moves])
             for i,nni_result in enumerate(nni_results):
                 if nni_result['status'] == "optimal":
                     new_score = nni_result['score']
                     if self.__accept_proposal__(curr_score,new_score,nni_iter): # accept the new tree and params               
-                        u,v,u_child,w = nni_result['cache']
+                        _,_,(u,v,u_child,w) = subset_nni_moves[i] # the nodes of self.treeList_obj
                         u_child.set_parent(v)
                         u.remove_child(u_child)
                         v.add_child(u_child)
                         w.set_parent(u)
                         v.remove_child(w)
                         u.add_child(w)
-                        self.update_from_solver(nni_result['mySolver'])
-                        self.treeList_obj = nni_result['treeList_obj']
+                        for index in self.anchor_index: # the index of the tree of v, where the anchors of v are not updated yet
+                            if index.nodes.get(v.anchors) is v:
+                                index.update([u,v])
+                        self.treeTopoList = nni_result['trees']
+                        self.params = nni_result['params']
                         took = True
                         break
                 elif not checked_all:
@@ -55,12 +94,14 @@ class Topology_search_parallel(Topology_search):
             curr_end_idx = min(curr_start_idx+batch_size,len(curr_queue))
         return new_score,curr_end_idx,took    
    
-    def apply_nni(self,arguments):
-        treeTopoList,score_tree_strategy,cache = arguments
-        mySolver = self.solver(treeTopoList,self.data,self.prior,self.params)            
-        score,status = mySolver.score_tree(strategy=score_tree_strategy)
-        nni_result = {'mySolver':mySolver,'score':score,'status':status,'cache':cache,'treeList_obj':self.treeList_obj}
-        return nni_result
+    def __score_nni__(self,tasks):
+        # auxiliary function, shoudn't be called outside
+        # score the candidate topologies of the tasks (see __nni_score__) in the pool of the search;
+        # a temporary pool is only opened if single_nni is called outside of search
+        if getattr(self,'pool',None) is not None:
+            return self.pool.map(__nni_score__,tasks)
+        with Pool(initializer=__nni_init__,initargs=(self.solver,self.data,self.prior)) as pool:
+            return pool.map(__nni_score__,tasks)
 
     def list_all_nni(self,strategy,only_marked=False):    
         branches = []
@@ -71,6 +112,13 @@ class Topology_search_parallel(Topology_search):
                 if not only_marked or node.mark:
                     branches.append(node)
         shuffle(branches)        
+        if strategy['local_brlen_opt']:
+            # the current branch lengths by the anchors of the branches of self.treeList_obj
+            brlen = []
+            for t,treeTopo in enumerate(self.treeTopoList):
+                keys = list(self.anchor_index[t].nodes)
+                nodes = Anchor_index(read_tree_newick(treeTopo)).find(keys)
+                brlen.append({anchors:node.edge_length for anchors,node in zip(keys,nodes)})
         all_nni_moves = []
         for u in branches:        
             v = u.get_parent()
@@ -85,26 +133,9 @@ class Topology_search_parallel(Topology_search):
                 score_tree_strategy['fixed_nu'] = self.params['nu'] 
                 score_tree_strategy['fixed_phi'] = self.params['phi'] 
                 free_branches = set(u.child_nodes() + v.child_nodes() + [v])
-                fixed_branches_anchors = [[] for _ in range(len(self.treeList_obj))]
-                for t,tree in enumerate(self.treeList_obj): 
-                    for node in tree.traverse_postorder():
-                        if node.is_leaf():
-                            node.anchors = (node.label,node.label)
-                        else:
-                            C = node.child_nodes()
-                            a = C[0].anchors[0]
-                            b = C[-1].anchors[0]
-                            node.anchors = (a,b)
-                        if not node in free_branches:
-                            fixed_branches_anchors[t].append(node.anchors)
-                fixed_branches = [[] for _ in range(len(self.treeList_obj))]            
-                for t,treeTopo in enumerate(self.treeTopoList):
-                    tree = read_tree_newick(treeTopo)
-                    fixed_branches[t] += find_LCAs(tree,fixed_branches_anchors[t])
-                fixed_brlen = [{} for _ in range(len(self.treeList_obj))]
-                for t,B in enumerate(fixed_branches):
-                    for i,node in enumerate(B):
-                        fixed_brlen[t][fixed_branches_anchors[t][i]] = node.edge_length
+                fixed_brlen = []
+                for t,index in enumerate(self.anchor_index):
+                    fixed_brlen.append({anchors:brlen[t][anchors] for anchors,node in index.nodes.items() if not node in free_branches})
                 score_tree_strategy['fixed_brlen'] = fixed_brlen
             shuffle(u_children)
             for u_child in u_children:
@@ -0,0 +1,52 @@
+from treeswift import *
+from laml_libs.sequence_lib import encode_charMtrx
+import numpy as np
+
+def find_duplicate_cells(charMtrx):
+# group the cells with identical character states (missing data included)
+# input: the character matrix, either as a dictionary that maps each cell to its list of states or as a CharMtrx
+# output: a dictionary that maps a representative cell (the first cell of its group in the matrix) to the tuple of all cells in its group
+# only groups of two or more cells are reported
+    charMtrx = encode_charMtrx(charMtrx)
+    # identical rows of the integer-encoded matrix
+    _,rows = np.unique(charMtrx.X,axis=0,return_inverse=True)
+    groups = {}
+    for cell,r in zip(charMtrx.cell_names,rows.reshape(-1)):
+        groups.setdefault(r,[]).append(cell)
+    return {g[0]:tuple(g) for g in groups.values() if len(g) > 1}
+
+def collapse_duplicates(treeList,groups):
+# collapse each group of duplicated cells into its representative
+# input: treeList is a list of newick strings, groups is the output of find_duplicate_cells
+# output:
+#   + the list of the reduced trees (newick strings), where all cells of each group except the representative are removed
+#   + leaf_weights: a dictionary that maps each representative to the size of its group
+    removed = set()
+    leaf_weights = {}
+    for rep in groups:
+        leaf_weights[rep] = len(groups[rep])
+        removed.update(x for x in groups[rep] if x != rep)
+    reduced_trees = []
+    for tree_str in treeList:
+        tree = read_tree_newick(tree_str)
+        labels = [node.label for node in tree.traverse_leaves() if node.label in removed]
+        if len(labels) > 0:
+            tree = tree.extract_tree_without(labels,suppress_unifurcations=True)
+        reduced_trees.append(tree.newick())
+    return reduced_trees,leaf_weights
+
+def expand_duplicates(tree,groups):
+# re-expand the duplicated cells in a reduced tree (a treeswift object); the tree is modified in place
+# the leaf of each representative becomes the parent of all cells of its group,
+# which are attached by zero-length branches, so the branch above the group keeps its length
+# output: a dictionary that maps each new leaf to the node of its representative in the reduced tree
+    new_leaves = {}
+    for node in list(tree.traverse_leaves()):
+        if node.label not in groups:
+            continue
+        for x in groups[node.label]:
+            leaf = Node(label=x,edge_length=0)
+            node.add_child(leaf)
+            new_leaves[leaf] = node
+        node.label = None
+    return new_leaves
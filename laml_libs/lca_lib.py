@@ -93,3 +93,72 @@ def find_LCAs(myTree,myQueries):
         myLCAs.append(lca)
     return myLCAs    
 
+
+class Anchor_index:
+    def __init__(self,tree):
+    # a persistent index of the anchors of the nodes of a tree, which identify a branch across the copies of the same topology
+    # (e.g. the keys of fixed_brlen in ML_solver.optimize): the anchors of an internal node are the labels of the first leaves
+    # below its first and its last child, so that the node is the LCA of its anchors; the anchors of a leaf are (label,label)
+    # the anchors are stored in node.anchors
+    # unlike find_LCAs, the index is built once: the node of a pair of anchors is found in O(1),
+    # and the index is updated in place after a local change of the topology (see update)
+        self.nodes = {} # anchors -> node
+        self.leaves = {} # label -> leaf
+        for node in tree.traverse_postorder():
+            self.__set_anchors__(node)
+
+    def __set_anchors__(self,node):
+        # auxiliary function, shoudn't be called outside
+        # (re)compute the anchors of the node from its children
+        # output: True if the anchors have changed
+        if node.is_leaf():
+            anchors = (node.label,node.label)
+            self.leaves[node.label] = node
+        else:
+            anchors = (node.children[0].anchors[0],node.children[-1].anchors[0])
+        old = getattr(node,'anchors',None)
+        if self.nodes.get(old) is node:
+            del self.nodes[old]
+        node.anchors = anchors
+        self.nodes[anchors] = node
+        return anchors != old
+
+    def update(self,nodes):
+    # Purpose: update the index after the children of the input nodes have changed (e.g. by an NNI); the set of nodes must be the same
+    # the input nodes are processed in the given order, so a node must come after its descendants among them
+    # the anchors of the ancestors are only recomputed as long as they change, so an NNI typically costs O(1) and at most O(depth)
+        for node in nodes:
+            while self.__set_anchors__(node) and node.parent is not None:
+                node = node.parent
+
+    def find(self,queries):
+    # Purpose: find the LCA of each query (a list of leaf labels), as in find_LCAs; a query that is the anchors of a node 
+    # is found in O(1), any other query by walking up from its leaves
+    # Output: the list of the LCA nodes (None if no leaf of the query is in the tree)
+        lcas = []
+        for q in queries:
+            lca = self.nodes.get(tuple(q))
+            lcas.append(lca if lca is not None else self.__lca__(q))
+        return lcas
+
+    def __lca__(self,q):
+        # auxiliary function, shoudn't be called outside
+        leaves = []
+        for a in q:
+            if a in self.leaves:
+                leaves.append(self.leaves[a])
+            else:    
+                logger.warning("ignored calibration for taxon " + a + " which is not found in the input tree")
+        if len(leaves) == 0:
+            logger.warning("failed to find lca for " + str(q))
+            return None
+        path = [leaves[0]]
+        while path[-1].parent is not None:
+            path.append(path[-1].parent)
+        pos = {node:k for k,node in enumerate(path)}
+        k = 0
+        for node in leaves[1:]:
+            while node not in pos:
+                node = node.parent
+            k = max(k,pos[node])
+        return path[k]
@@ -0,0 +1,210 @@
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.linalg import spsolve
+
+# Solvers for the branch-length subproblem of the M-step of EM_solver.
+# Given the expected sufficient statistics S0,...,S4 of the free branches (arrays of length N) and nu,
+# the M-step maximizes the separable concave function
+#   F(d) = sum_e f_e(d_e), where f_e(d) = -a_e*d + S1_e*log(1-exp(-d)) + S24_e*log(1-exp(-nu*d))
+#   a_e = (nu+1)*S0_e + nu*(S1_e+S3_e) and S24_e = S2_e + S4_e (dropped when nu <= eps_nu)
+# subject to dmin <= d_e <= dmax and, optionally, the ultrametric constraints.
+
+def brlen_llh(d,S,nu,eps_nu=1e-5):
+# the objective F(d) together with its gradient and the diagonal of its Hessian (F is separable)
+    S0,S1,S2,S3,S4 = S
+    a = (nu+1)*S0 + nu*(S1+S3)
+    em1 = np.expm1(d)
+    f = -np.dot(a,d) + np.dot(S1,np.log(-np.expm1(-d)))
+    g = -a + S1/em1
+    h = -S1*(em1+1)/em1**2
+    if nu > eps_nu:
+        S24 = S2 + S4
+        em1_nu = np.expm1(nu*d)
+        f += np.dot(S24,np.log(-np.expm1(-nu*d)))
+        g += S24*nu/em1_nu
+        h -= S24*nu**2*(em1_nu+1)/em1_nu**2
+    return f,g,h
+
+def optimize_brlen_separable(S,nu,dmin,dmax,eps_nu=1e-5,tol=1e-12,maxIter=200):
+# maximize F(d) under the box constraints only
+# F is separable and each f_e is strictly concave, so every branch is optimized independently by
+# a safeguarded Newton search for the root of f_e' (which is decreasing) in [dmin,dmax]
+# all branches are processed together in vectorized form
+# output: the optimal d and the status
+    N = len(S[0])
+    _,g_lo,_ = brlen_llh(np.full(N,dmin),S,nu,eps_nu=eps_nu)
+    _,g_hi,_ = brlen_llh(np.full(N,dmax),S,nu,eps_nu=eps_nu)
+    d = np.where(g_lo <= 0,dmin,dmax)
+    active = (g_lo > 0) & (g_hi < 0)
+    lo = np.full(N,dmin)
+    hi = np.full(N,dmax)
+    x = (lo+hi)/2
+    for _ in range(maxIter):
+        if not np.any(active):
+            break
+        _,g,h = brlen_llh(x,S,nu,eps_nu=eps_nu)
+        # shrink the bracket around the root of f'
+        lo = np.where(g > 0,x,lo)
+        hi = np.where(g > 0,hi,x)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            x_new = x - g/h
+        # fall back to bisection whenever the Newton step leaves the bracket
+        outside = ~((x_new > lo) & (x_new < hi))
+        x_new = np.where(outside,(lo+hi)/2,x_new)
+        converged = (np.abs(x_new-x) <= tol*np.maximum(1,x)) | (hi-lo <= tol*np.maximum(1,x))
+        x = np.where(active,x_new,x)
+        active &= ~converged
+    d = np.where((g_lo > 0) & (g_hi < 0),x,d)
+    status = "optimal" if not np.any(active) else "UNKNOWN"
+    return d,status
+
+def optimize_brlen_closed_form(S,nu,dmin,dmax,eps_nu=1e-5):
+# maximize F(d) under the box constraints only, in the regime nu <= eps_nu (e.g. no silencing) where the S24 terms are dropped
+# f_e'(d) = -a_e + S1_e/(exp(d)-1) has the root d = log(1 + S1_e/a_e), which reduces to -log(S0_e/(S0_e+S1_e)) if nu = 0;
+# f_e is concave, so clipping the root to [dmin,dmax] gives the optimum
+    S0,S1,_,S3,_ = S
+    a = (nu+1)*S0 + nu*(S1+S3)
+    return np.clip(np.log1p(S1/a),dmin,dmax),"optimal"
+
+def optimize_nu_scalar(S,d,nu_ini=None,tol=1e-12,maxIter=200):
+# maximize G(nu) = -c*nu + sum_e S24_e*log(1-exp(-nu*d_e)) over nu >= 0, where c = (S0+S1+S3) @ d and S24 = S2 + S4
+# (the terms of F that depend on nu, for fixed branch lengths d)
+# G is concave and G'(nu) = -c + sum_e S24_e*d_e/(exp(nu*d_e)-1) decreases from +inf (at nu = 0) to -c,
+# so its root is found by a safeguarded Newton search in a bracket [lo,hi], warm-started from nu_ini
+# output: the optimal nu and the status
+    S0,S1,S2,S3,S4 = S
+    c = np.dot(S0+S1+S3,d)
+    S24 = S2 + S4
+    if not np.any(S24*d > 0):
+        return 0.0,"optimal"
+    if c <= 0: # G is increasing
+        return None,"unbounded"
+    def __derivatives__(nu):
+        em1 = np.expm1(nu*d)
+        return -c + np.sum(S24*d/em1), -np.sum(S24*d**2*(em1+1)/em1**2)
+    lo = 0.0
+    hi = 1.0
+    while __derivatives__(hi)[0] > 0:
+        lo = hi
+        hi *= 2
+    x = nu_ini if nu_ini is not None and lo < nu_ini < hi else (lo+hi)/2
+    for _ in range(maxIter):
+        g,h = __derivatives__(x)
+        # shrink the bracket around the root of G'
+        if g > 0:
+            lo = x
+        else:
+            hi = x
+        x_new = x - g/h
+        # fall back to bisection whenever the Newton step leaves the bracket
+        if not lo < x_new < hi:
+            x_new = (lo+hi)/2
+        if abs(x_new-x) <= tol*max(1,x) or hi-lo <= tol*max(1,x):
+            return x_new,"optimal"
+        x = x_new
+    return x,"UNKNOWN"
+
+def __heights_matrix__(height_param):
+    # auxiliary function, shoudn't be called outside
+    # the matrix B of the height parameterization d = B @ H + c (see optimize_brlen_heights), its transpose, and the number of free heights
+    par_col,child_col,c = height_param
+    N = len(c)
+    G = max(np.max(par_col,initial=-1),np.max(child_col,initial=-1)) + 1
+    rows = np.arange(N)
+    # the pinned height is stored in the extra column G, which is dropped
+    cols = np.concatenate([par_col,child_col])
+    cols[cols < 0] = G
+    B = csr_matrix((np.concatenate([np.ones(N),-np.ones(N)]),(np.concatenate([rows,rows]),cols)),shape=(N,G+1))[:,:G]
+    return B,B.T.tocsr(),G
+
+def __heights_start__(height_param,G,d_len):
+    # auxiliary function, shoudn't be called outside
+    # the columns are sorted so that child_col[e] < par_col[e] whenever both are free heights,
+    # so the heights can be set greedily from the bottom up such that every branch is at least d_len[e]
+    par_col,child_col,c = height_param
+    H = np.zeros(G+1)
+    order = np.argsort(par_col,kind='stable')
+    for e in order:
+        if par_col[e] >= 0:
+            H[par_col[e]] = max(H[par_col[e]],H[child_col[e]] + d_len[e] - c[e])
+    return H[:G]
+
+def optimize_brlen_heights(S,nu,dmin,dmax,height_param,d_ini,eps_nu=1e-5,tol=1e-9,sigma=0.1,maxIter=200):
+# maximize F(d) under the box constraints and the ultrametric constraints
+# the ultrametric trees are parameterized by the heights of their nodes (see EM_solver.ultrametric_heights):
+#   d_e = H[par_col[e]] - H[child_col[e]] + c[e], where H[-1] is the constant 0 (pinned height)
+# so the equality constraints are eliminated and only the box constraints remain.
+# The problem is solved by a primal-dual interior point method, with the slacks s1 = d-dmin, s2 = dmax-d and their duals z1, z2.
+# After eliminating the slacks and the duals, each Newton step solves B^T diag(D) B dH = B^T r, where D = F'' - z1/s1 - z2/s2
+# and B is the incidence matrix of a tree, so it is a sparse solve with no fill-in. Unlike a barrier method, the barrier
+# parameter is driven by the duality gap (mu = sigma*gap) in every step, which typically converges in 10-15 steps.
+# output: the optimal d and the status ("optimal", or "failure" if no strictly feasible starting point is found
+# or the method does not converge)
+    par_col,child_col,c = height_param
+    N = len(c)
+    B,Bt,G = __heights_matrix__(height_param)
+
+    def __brlen__(H):
+        return B @ H + c
+
+    def __start__(d_len):
+        return __heights_start__(height_param,G,d_len)
+
+    def __feasible__(d):
+        return np.all(d > dmin) and np.all(d < dmax)
+
+    H = __start__(np.clip(d_ini,1.5*dmin,dmax))
+    if not __feasible__(__brlen__(H)):
+        H = __start__(np.full(N,1.5*dmin))
+        if not __feasible__(__brlen__(H)):
+            return d_ini,"failure"
+    if G == 0:
+        return __brlen__(H),"optimal"
+
+    def __residual__(d,z1,z2,mu):
+        # the norm of the residual of the perturbed KKT conditions
+        f,g,h = brlen_llh(d,S,nu,eps_nu=eps_nu)
+        r_dual = Bt @ (g+z1-z2)
+        r_cent1 = z1*(d-dmin) - mu
+        r_cent2 = z2*(dmax-d) - mu
+        return np.sqrt(np.dot(r_dual,r_dual) + np.dot(r_cent1,r_cent1) + np.dot(r_cent2,r_cent2)),f,g,h
+
+    d = __brlen__(H)
+    f,g,h = brlen_llh(d,S,nu,eps_nu=eps_nu)
+    s1 = d - dmin
+    s2 = dmax - d
+    mu = max(1e-3,np.max(np.abs(g))*np.min(np.minimum(s1,s2)))
+    z1 = mu/s1
+    z2 = mu/s2
+    for _ in range(maxIter):
+        s1 = d - dmin
+        s2 = dmax - d
+        gap = (np.dot(z1,s1) + np.dot(z2,s2))/(2*N)
+        r_dual = Bt @ (g+z1-z2)
+        if 2*N*gap <= tol*max(1,abs(f)) and np.linalg.norm(r_dual) <= tol*max(1,abs(f)):
+            return d,"optimal"
+        mu = sigma*gap
+        D = h - z1/s1 - z2/s2
+        delta = spsolve((Bt @ diags(-D) @ B).tocsc(),Bt @ (g + mu/s1 - mu/s2))
+        delta_d = B @ delta
+        delta_z1 = (mu - z1*s1 - z1*delta_d)/s1
+        delta_z2 = (mu - z2*s2 + z2*delta_d)/s2
+        # the largest step that keeps the slacks and the duals positive
+        step_max = 1
+        for v,dv in [(s1,delta_d),(s2,-delta_d),(z1,delta_z1),(z2,delta_z2)]:
+            if np.any(dv < 0):
+                step_max = min(step_max,np.min(-v[dv < 0]/dv[dv < 0]))
+        step = min(1,0.99*step_max)
+        # backtracking line search on the norm of the residual
+        r0,_,_,_ = __residual__(d,z1,z2,mu)
+        while True:
+            r1,f_new,g_new,h_new = __residual__(d + step*delta_d,z1 + step*delta_z1,z2 + step*delta_z2,mu)
+            if r1 <= (1-0.01*step)*r0 or step < 1e-12:
+                break
+            step *= 0.5
+        H = H + step*delta
+        d = __brlen__(H)
+        z1 = z1 + step*delta_z1
+        z2 = z2 + step*delta_z2
+        f,g,h = f_new,g_new,h_new
+    return d,"failure"
@@ -1,10 +1,69 @@
 #! /usr/bin/env python
 from statistics import mean
 import pickle
+import numpy as np
 
 recognized_missing = set(['-', '?', '-1'])
 
+# sentinel codes of the integer-encoded character matrix
+MISSING = -2 # missing data ('?')
+SILENCED = -1 # heritable silencing
+
+class CharMtrx:
+    # compact representation of a character matrix:
+    #   + X: a 2-D integer array of shape (number of cells, number of sites), where 0 is the unmutated state,
+    #     positive integers are the mutated states, and MISSING and SILENCED are the sentinel codes of the masked entries
+    #   + cell_names: the name of each row of X; cell_index maps a cell name to its row
+    #   + site_names: the name of each column of X (optional)
+    def __init__(self,X,cell_names,site_names=None):
+        X = np.asarray(X)
+        dtype = np.int16 if X.size == 0 or X.max() <= np.iinfo(np.int16).max else np.int32
+        self.X = X.astype(dtype)
+        self.cell_names = list(cell_names)
+        self.cell_index = {c:i for i,c in enumerate(self.cell_names)}
+        self.site_names = site_names
+    
+    def __len__(self):
+        return len(self.cell_names)
+    
+    def __contains__(self,cell):
+        return cell in self.cell_index
+
+    def keys(self):
+        return self.cell_names
+
+    def __getitem__(self,cell):
+        # decode the row of a cell to a list of states with '?' for the missing entries
+        return ['?' if x == MISSING else int(x) for x in self.X[self.cell_index[cell]]]
+
+    def to_dict(self):
+        return {cell:self[cell] for cell in self.cell_names}
+
+def encode_charMtrx(char_mtrx,site_names=None):
+    # convert a character matrix given as a dictionary (cell name --> list of states, with '?' for missing data)
+    # to the compact integer-encoded representation (see CharMtrx)
+    if isinstance(char_mtrx,CharMtrx):
+        return char_mtrx
+    cell_names = list(char_mtrx.keys())
+    X = [[MISSING if x == '?' else x for x in char_mtrx[cell]] for cell in cell_names]
+    return CharMtrx(np.array(X,dtype=int).reshape(len(cell_names),-1),cell_names,site_names=site_names)
+
+def encode_priors(Q,max_state=0):
+    # convert the priors given as a list of dictionaries (one per site, mapping each state to its probability; 
+    # the states can be either int or str, e.g. {"1":1.0} for a pseudo-state) to a dense array of shape 
+    # (number of sites, max_state+1) aligned with the integer-encoded states: entry [site][a] is the prior of state a
+    # the prior of each site is normalized to sum to 1
+    max_state = max([max_state]+[int(x) for Q_i in Q for x in Q_i])
+    Q_dense = np.zeros((len(Q),max_state+1))
+    for site,Q_i in enumerate(Q):
+        for x in Q_i:
+            Q_dense[site][int(x)] += Q_i[x]
+    return Q_dense/Q_dense.sum(axis=1,keepdims=True)
+
 def write_sequences(char_mtrx,nsites,outFile,delimiter=","):
+    # char_mtrx can either be a dictionary or a CharMtrx
+    if isinstance(char_mtrx,CharMtrx):
+        char_mtrx = char_mtrx.to_dict()
     with open(outFile,'w') as fout:
         # header
         fout.write("cell")
@@ -20,14 +79,14 @@ def write_sequences(char_mtrx,nsites,outFile,delimiter=","):
             fout.write("\n")
 
 
-def read_sequences(inFile,filetype="charMtrx",delimiter=",",masked_symbol=None, suppress_warnings=False, replace_mchar='?'):
+def read_sequences(inFile,filetype="charMtrx",delimiter=",",masked_symbol=None, suppress_warnings=False, replace_mchar='?', encode=False):
     with open(inFile,'r') as fin:
         if filetype == "fasta":
             if not suppress_warnings: 
                 print("Warning: Reading " + str(inFile) + " as fasta file. Processing missing data in these files is not yet implemented.")
             return read_fasta(fin)
         elif filetype == "charMtrx":
-            return read_charMtrx(fin,delimiter=delimiter,masked_symbol=masked_symbol,suppress_warnings=suppress_warnings,replace_mchar=replace_mchar)
+            return read_charMtrx(fin,delimiter=delimiter,masked_symbol=masked_symbol,suppress_warnings=suppress_warnings,replace_mchar=replace_mchar,encode=encode)
 
 def read_fasta(fin):    
     S = [] # will be a list of dictionaries
@@ -57,7 +116,8 @@ def check_missing(seen_missing, x):
         except:
             return False
 
-def read_charMtrx(fin,delimiter=",",masked_symbol=None,suppress_warnings=False,replace_mchar='?',convert_to_int=True,stop_key=None):
+def read_charMtrx(fin,delimiter=",",masked_symbol=None,suppress_warnings=False,replace_mchar='?',convert_to_int=True,stop_key=None,encode=False):
+    # if encode is True, return the integer-encoded CharMtrx instead of a dictionary (requires replace_mchar='?' and convert_to_int=True)
     D = {}
 
     site_names = fin.readline().strip().split(delimiter)
@@ -93,6 +153,8 @@ def read_charMtrx(fin,delimiter=",",masked_symbol=None,suppress_warnings=False,r
     #    print("Warning: Found " + str(seen_missing) + " characters and treated them as missing.")
     #elif masked_symbol == None and len(seen_missing) >= 1 and not suppress_warnings:
     #    print("Warning: Reading sequences, detected " + str(seen_missing) + " as the missing character(s). We recommend explicitly providing the missing character.")
+    if encode:
+        return encode_charMtrx(D,site_names=site_names), site_names
     return D, site_names    
 
 def read_Q(inFile,has_head=True):
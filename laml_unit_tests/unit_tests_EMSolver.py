@@ -1,7 +1,12 @@
 import unittest
-from laml_libs.sequence_lib import read_sequences
+from laml_libs.sequence_lib import read_sequences, encode_charMtrx
 from laml_libs.EM_solver import EM_solver
 from laml_libs.ML_solver import ML_solver
+from laml_libs.duplicate_lib import find_duplicate_cells, collapse_duplicates, expand_duplicates
+from laml_libs.mstep_lib import brlen_llh, optimize_brlen_separable, optimize_brlen_closed_form, optimize_brlen_heights, optimize_nu_scalar
+from scipy import optimize
+import numpy as np
+import cvxpy as cp
 from treeswift import *
 from math import log
 from random import random
@@ -276,12 +281,12 @@ class EMTest(unittest.TestCase):
         mySolver.az_partition()
         mySolver.Estep_in_llh()
         mySolver.Estep_out_llh()
-        out0 = {} # mapping node label to node.out0
-        out1 = {} # mapping node label to node.out1
+        out0 = {} # mapping node label to its out0
+        out1 = {} # mapping node label to its out1
         
         for node in mySolver.trees[0].traverse_postorder():
-            out0[node.label] = node.out0
-            out1[node.label] = node.out1
+            out0[node.label] = mySolver.out0[node.idx][mySolver.site_index]
+            out1[node.label] = mySolver.out1[node.idx][mySolver.site_index]
         tree_reduced = self.__get_reduced_trees__(mySolver.trees[0].newick())
         for x in tree_reduced:    
             # test out0
@@ -291,7 +296,7 @@ class EMTest(unittest.TestCase):
             mySolver0 = EM_solver([tree_str],{'charMtrx':msa0},{'Q':Q},{'phi':phi,'nu':nu})
             mySolver0.az_partition()
             mySolver0.Estep_in_llh()
-            for true,est in zip(mySolver0.trees[0].root.L0,out0[x]):
+            for true,est in zip(mySolver0.L0[mySolver0.trees[0].root.idx][mySolver0.site_index],out0[x]):
                 self.assertAlmostEqual(true,est+log(1-phi),places=5,msg="EMTest: test_" + str(test_no) + " failed.")
             # test out1            
             msa1 = {y:msa[y] for y in msa}
@@ -299,7 +304,7 @@ class EMTest(unittest.TestCase):
             mySolver1 = EM_solver([tree_str],{'charMtrx':msa1},{'Q':Q},{'phi':phi,'nu':nu})
             mySolver1.az_partition()
             mySolver1.Estep_in_llh()
-            for true,est in zip(mySolver1.trees[0].root.L0,out1[x]):
+            for true,est in zip(mySolver1.L0[mySolver1.trees[0].root.idx][mySolver1.site_index],out1[x]):
                 self.assertAlmostEqual(true,est,places=5,msg="EMTest: test_" + str(test_no) + " failed.")
 
     def test_21(self):
@@ -600,3 +605,436 @@ class EMTest(unittest.TestCase):
         self.assertAlmostEqual(abs(true_nllh-nllh)/true_nllh,0,places=4,msg="EMTest: test_48 failed.")
         self.assertAlmostEqual(true_phi,phi,places=4,msg="EMTest: test_48 failed.")
         self.assertAlmostEqual(true_nu,nu,places=4,msg="EMTest: test_48 failed.")
+
+    # test the vectorized inside pass with mixed missing ('?'), silenced (-1), and mutated states
+    def test_49(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        T = "((a:1,b:0.5):1,(c:0.5,d:1):0.2):1;"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1]}
+        true_nllh = 27.896232825667305
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        my_nllh = mySolver.negative_llh()
+        self.assertAlmostEqual(true_nllh,my_nllh,places=5,msg="EMTest: test_49 failed.")
+
+    def test_50(self):
+        treedata_path = pkg_resources.resource_filename('laml_unit_tests', 'test_data/test_EM/test1.tre')
+        msa_path = pkg_resources.resource_filename('laml_unit_tests', 'test_data/test_EM/test1_charMtrx.txt')
+        T = read_tree_newick(treedata_path).newick()
+        msa,_ = read_sequences(msa_path,filetype="charMtrx",delimiter=",",masked_symbol='-',suppress_warnings=True)
+        Q = []
+        for i in range(60):
+            M_i = set(msa[x][i] for x in msa if msa[x][i] not in [0,"?"])
+            q = {x:1/len(M_i) for x in M_i}
+            q[0] = 0
+            Q.append(q)
+        true_nllh = 5639.328420438454
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.05,'nu':0.15})
+        mySolver.az_partition()
+        my_nllh = mySolver.negative_llh()
+        self.assertAlmostEqual(true_nllh,my_nllh,places=5,msg="EMTest: test_50 failed.")
+
+    # test the outside pass where a node must keep out_alpha for two different alpha states
+    def test_51(self):
+        T = "((((a:0.5,b:1)e:1,c:0.3)f:0.4,d:1)g:0.2,h:0.7)r:0.5;"
+        Q = [{1:0.6,2:0.4},{1:0.5,2:0.5},{1:0.3,2:0.7}]
+        msa = {'a':[1,2,1],'b':[2,'?',1],'c':['?',2,-1],'d':[1,'?',0],'h':['?',2,1]}
+        phi = 0.2
+        nu = 0.3
+        self.__test_outllh__(T,Q,msa,phi,nu,51)
+
+    # test the per-edge sufficient statistics of the fused E-step
+    def test_52(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        T = "((a:1,b:0.5):1,(c:0.5,d:1):0.2):1;"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1]}
+        true_S = [[1.007611, 0.19677, 0.054691, 1.85186, 0.201769], [0.022284, 1.198147, 0.038641, 1.931978, 0.121651], 
+                  [1.259072, 1.945835, 0.978103, 0.107794, 0.709196], [2.109383, 0.167781, 1.189667, 0.943106, 0.041993], 
+                  [1.114461, 1.293498, 1.058873, 0.903178, 0.081921], [3.466831, 0.168109, 0.54807, 0.81699, 0.0], [4.18301, 0.81699, 0.0, 0.0, 0.0]]
+        true_R_tilde = 0.7400575917616219
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        mySolver.Estep()
+        for i,node in enumerate(mySolver.trees[0].traverse_postorder()):
+            for k in range(5):
+                self.assertAlmostEqual(true_S[i][k],mySolver.S_sum[k][node.idx],places=5,msg="EMTest: test_52 failed.")
+        self.assertAlmostEqual(true_R_tilde,sum(mySolver.R_tilde),places=5,msg="EMTest: test_52 failed.")
+        self.assertEqual(sum(mySolver.R),15,msg="EMTest: test_52 failed.")
+
+    # test the reuse of the storage arena across E-steps
+    def test_53(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        T = "((a:1,b:0.5):1,(c:0.5,d:1):0.2):1;"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1]}
+        true_nllh = 27.896232825667305
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        mySolver.Estep()
+        L0,post0,S_sum = mySolver.L0,mySolver.post0,mySolver.S_sum
+        self.assertEqual(L0.shape,(7,5),msg="EMTest: test_53 failed.")
+        my_nllh = mySolver.negative_llh()
+        mySolver.Estep()
+        self.assertAlmostEqual(true_nllh,my_nllh,places=5,msg="EMTest: test_53 failed.")
+        self.assertTrue(L0 is mySolver.L0 and post0 is mySolver.post0 and S_sum is mySolver.S_sum,msg="EMTest: test_53 failed.")
+
+    # test site-pattern compression: duplicating every site doubles the likelihood and the sufficient statistics
+    def test_54(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        T = "((a:1,b:0.5):1,(c:0.5,d:1):0.2):1;"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1]}
+        true_nllh = 27.896232825667305
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        mySolver.Estep()
+        msa2 = {x:msa[x]+msa[x] for x in msa}
+        mySolver2 = EM_solver([T],{'charMtrx':msa2},{'Q':Q+Q},{'phi':0.1,'nu':0.2})
+        self.assertEqual(mySolver2.num_patterns,5,msg="EMTest: test_54 failed.")
+        my_nllh = mySolver2.negative_llh()
+        self.assertAlmostEqual(2*true_nllh,my_nllh,places=5,msg="EMTest: test_54 failed.")
+        mySolver2.Estep()
+        for x,y in zip(mySolver.S_sum.flatten(),mySolver2.S_sum.flatten()):
+            self.assertAlmostEqual(2*x,y,places=5,msg="EMTest: test_54 failed.")
+        self.assertAlmostEqual(2*sum(mySolver.R_tilde),sum(mySolver2.R_tilde),places=5,msg="EMTest: test_54 failed.")
+
+    # test weighted leaves: a leaf representing 3 identical cells has the same likelihood as the 3 cells attached by zero-length branches
+    def test_55(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'b2':[1,'?','?',2,2],'b3':[1,'?','?',2,2]}
+        T_full = "((a:1,((b:0,b2:0):0,b3:0):0.5):1,(c:0.5,d:1):0.2):1;"
+        T = "((a:1,b:0.5):1,(c:0.5,d:1):0.2):1;"
+        
+        solver_full = EM_solver([T_full],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver = EM_solver([T],{'charMtrx':msa,'leaf_weights':{'b':3}},{'Q':Q},{'phi':0.1,'nu':0.2})
+        self.assertAlmostEqual(solver_full.negative_llh(),mySolver.negative_llh(),places=5,msg="EMTest: test_55 failed.")
+        solver_full.Estep()
+        mySolver.Estep()
+        self.assertAlmostEqual(sum(solver_full.R_tilde),sum(mySolver.R_tilde),places=5,msg="EMTest: test_55 failed.")
+        self.assertAlmostEqual(sum(solver_full.R),sum(mySolver.R),places=5,msg="EMTest: test_55 failed.")
+        # the same for the generic solver
+        solver_full = ML_solver([T_full],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver = ML_solver([T],{'charMtrx':msa,'leaf_weights':{'b':3}},{'Q':Q},{'phi':0.1,'nu':0.2})
+        self.assertAlmostEqual(solver_full.negative_llh(),mySolver.negative_llh(),places=5,msg="EMTest: test_55 failed.")
+
+    # test collapsing and re-expanding duplicated cells
+    def test_56(self):
+        T = "((a:1,(b:0.5,b2:0.3):0.5):1,((c:0.5,b3:1):0.2,d:0.7):1);"
+        groups = {'b':('b','b2','b3')}
+        reduced_trees,leaf_weights = collapse_duplicates([T],groups)
+        self.assertEqual(leaf_weights,{'b':3},msg="EMTest: test_56 failed.")
+        tree = read_tree_newick(reduced_trees[0])
+        self.assertEqual(sorted(tree.labels(internal=False)),['a','b','c','d'],msg="EMTest: test_56 failed.")
+        new_leaves = expand_duplicates(tree,groups)
+        self.assertEqual(sorted(tree.labels(internal=False)),['a','b','b2','b3','c','d'],msg="EMTest: test_56 failed.")
+        self.assertEqual(len(new_leaves),3,msg="EMTest: test_56 failed.")
+        for leaf in new_leaves:
+            self.assertEqual(leaf.edge_length,0,msg="EMTest: test_56 failed.")
+            self.assertTrue(leaf.parent is new_leaves[leaf],msg="EMTest: test_56 failed.")
+
+    # test the integer-encoded character matrix
+    def test_57(self):
+        treedata_path = pkg_resources.resource_filename('laml_unit_tests', 'test_data/test_EM/test1.tre')
+        msa_path = pkg_resources.resource_filename('laml_unit_tests', 'test_data/test_EM/test1_charMtrx.txt')
+        T = read_tree_newick(treedata_path).newick()
+        msa,_ = read_sequences(msa_path,filetype="charMtrx",delimiter=",",masked_symbol='-',suppress_warnings=True)
+        charMtrx,_ = read_sequences(msa_path,filetype="charMtrx",delimiter=",",masked_symbol='-',suppress_warnings=True,encode=True)
+        self.assertEqual(charMtrx.to_dict(),msa,msg="EMTest: test_57 failed.")
+        Q = []
+        for i in range(60):
+            M_i = set(msa[x][i] for x in msa if msa[x][i] not in [0,"?"])
+            q = {x:1/len(M_i) for x in M_i}
+            q[0] = 0
+            Q.append(q)
+        true_nllh = 5639.328420438454
+
+        mySolver = EM_solver([T],{'charMtrx':charMtrx},{'Q':Q},{'phi':0.05,'nu':0.15})
+        mySolver.az_partition()
+        my_nllh = mySolver.negative_llh()
+        self.assertAlmostEqual(true_nllh,my_nllh,places=5,msg="EMTest: test_57 failed.")
+
+    # test the dense prior: unnormalized priors with mixed str/int keys
+    def test_58(self):
+        Q = [{1:3,2:2},{"1":2.0,0:0},{1:0.5,2:0.5},{1:0.3,2:0.7},{"1":0.2,2:0.8}]
+        T = "((a:1,b:0.5):1,(c:0.5,d:1):0.2):1;"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1]}
+        true_nllh = 27.896232825667305
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        self.assertEqual(mySolver.Q.shape,(5,3),msg="EMTest: test_58 failed.")
+        my_nllh = mySolver.negative_llh()
+        self.assertAlmostEqual(true_nllh,my_nllh,places=5,msg="EMTest: test_58 failed.")
+
+    # test the incremental update of the az-partition
+    def test_59(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        T = "(((a:1,b:0.5):1,(c:0.5,d:1):0.2):1,e:0.4):0.2;"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[1,1,2,2,'?']}
+        msa_new = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[1,1,'?',2,1],'d':[1,1,'?',-1,1],'e':[1,1,2,2,'?']}
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        trueSolver = EM_solver([T],{'charMtrx':msa_new},{'Q':Q},{'phi':0.1,'nu':0.2})
+        trueSolver.az_partition()
+        # replace the cherry (c,d) by cells that have the character states of msa_new
+        mySolver.charMtrx = trueSolver.charMtrx
+        c,d = [node.idx for node in mySolver.trees[0].traverse_leaves() if node.label in ['c','d']]
+        changed = mySolver.update_az_partition([c,d])
+        self.assertTrue(len(changed) > 0,msg="EMTest: test_59 failed.")
+        for i in range(mySolver.num_nodes):
+            self.assertEqual(list(mySolver.alpha[i]),list(trueSolver.alpha[i]),msg="EMTest: test_59 failed.")
+            self.assertEqual(list(mySolver.log_q[i]),list(trueSolver.log_q[i]),msg="EMTest: test_59 failed.")
+        self.assertAlmostEqual(mySolver.lineage_llh(),trueSolver.lineage_llh(),places=5,msg="EMTest: test_59 failed.")
+
+    # test the M-step branch-length solvers against SLSQP
+    def test_60(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        T = "((a:1,b:0.5,e:0.3):1,(c:0.5,d:1,f:1):0.2):1;"
+        nu = 0.2
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':nu})
+        a = [node.idx for node in mySolver.trees[0].traverse_leaves() if node.label == 'a'][0]
+        mySolver.mark_fixed[a] = True
+        mySolver.brlen[a] = 0.3
+        mySolver.az_partition()
+        mySolver.Estep()
+        free = mySolver.__free_edges__()
+        S = np.maximum(1e-6,mySolver.S_sum[:,free])
+        S = S/np.sum(S,axis=0)*mySolver.numsites
+        M,b = mySolver.ultrametric_constr()
+        bounds = optimize.Bounds(mySolver.dmin,mySolver.dmax)
+        for ultra_constr in [False,True]:
+            if ultra_constr:
+                d,status = optimize_brlen_heights(S,nu,mySolver.dmin,mySolver.dmax,mySolver.ultrametric_heights(),mySolver.brlen[free])
+                constraints = [optimize.LinearConstraint(M,b,b)]
+                self.assertAlmostEqual(np.max(np.abs(M @ d - b)),0,places=8,msg="EMTest: test_60 failed.")
+            else:
+                d,status = optimize_brlen_separable(S,nu,mySolver.dmin,mySolver.dmax)
+                constraints = []
+            self.assertEqual(status,"optimal",msg="EMTest: test_60 failed.")
+            self.assertTrue(np.all(d >= mySolver.dmin) and np.all(d <= mySolver.dmax),msg="EMTest: test_60 failed.")
+            out = optimize.minimize(lambda x: -brlen_llh(x,S,nu)[0],np.full(len(d),0.5),jac=lambda x: -brlen_llh(x,S,nu)[1],method="SLSQP",bounds=bounds,constraints=constraints,options={'ftol':1e-12,'maxiter':1000})
+            self.assertAlmostEqual(brlen_llh(d,S,nu)[0],-out.fun,places=5,msg="EMTest: test_60 failed.")
+
+    # test that the conic M-step problems are parameterized (compiled once per EM run)
+    def test_61(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        T = "((a:1,b:0.5):1,(c:0.5,d:1):0.2):1;"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1]}
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        N = int(np.sum(mySolver.__free_edges__()))
+        prob,_,_,params = mySolver.__brlen_conic_problem__(N,ultra_constr_cache=mySolver.ultrametric_constr())
+        self.assertTrue(prob.is_dpp(),msg="EMTest: test_61 failed.")
+        self.assertEqual(len(prob.parameters()),len(params),msg="EMTest: test_61 failed.")
+        prob,_,_,params = mySolver.__nu_conic_problem__(N)
+        self.assertTrue(prob.is_dpp(),msg="EMTest: test_61 failed.")
+        self.assertEqual(len(prob.parameters()),len(params),msg="EMTest: test_61 failed.")
+
+    # test racing of the initial points
+    def test_62(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        T = "((a,b,e),(c,d,f));"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        options = {'fixed_phi':None,'fixed_nu':0.1,'verbose':-1,'ultra_constr':True}
+
+        # a resumed EM gives the same result as an uninterrupted one
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.1})
+        brlen_ini = mySolver.brlen.copy()
+        nllh,_,_,_,finished = mySolver.__race_initial__(0,1984,brlen_ini,**options)
+        self.assertTrue(finished,msg="EMTest: test_62 failed.")
+        _,_,state,_,finished = mySolver.__race_initial__(0,1984,brlen_ini,maxIter=2,**options)
+        self.assertFalse(finished,msg="EMTest: test_62 failed.")
+        nllh_resumed,_,_,_,finished = mySolver.__race_initial__(0,None,brlen_ini,state=state,maxIter=998,**options)
+        self.assertTrue(finished,msg="EMTest: test_62 failed.")
+        self.assertAlmostEqual(nllh,nllh_resumed,places=6,msg="EMTest: test_62 failed.")
+
+        # racing keeps the best initial point
+        results = []
+        for race_iters in [0,2]:
+            mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.1})
+            nllh,_ = mySolver.optimize(initials=4,fixed_nu=0.1,verbose=-1,random_seeds=1984,ultra_constr=True,race_iters=race_iters)
+            results.append(nllh)
+        self.assertAlmostEqual(results[0],results[1],places=6,msg="EMTest: test_62 failed.")
+
+    # test the SQUAREM acceleration of EM
+    def test_63(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        T = "(((a,b),e),((c,d),f));"
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        results = []
+        for accelerate in [False,True]:
+            for ultra_constr in [False,True]:
+                mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.1})
+                nllh,_ = mySolver.optimize(initials=1,fixed_nu=0.1,verbose=-1,random_seeds=1984,ultra_constr=ultra_constr,accelerate=accelerate)
+                results.append(nllh)
+                if ultra_constr:
+                    M,b = mySolver.ultrametric_constr()
+                    self.assertTrue(np.allclose(M @ mySolver.brlen[mySolver.__free_edges__()],b),msg="EMTest: test_63 failed.")
+        self.assertAlmostEqual(results[0],results[2],places=4,msg="EMTest: test_63 failed.")
+        self.assertAlmostEqual(results[1],results[3],places=4,msg="EMTest: test_63 failed.")
+
+    # test the M-step branch-length solvers without silencing (nu = 0) against SLSQP
+    def test_64(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        msa = {'a':[1,'?','?',0,2],'b':[1,'?','?',2,2],'c':['?',1,0,'?',0],'d':[0,1,'?','?',1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        T = "(((a:1,b:0.5):0.2,e:0.3):1,(c:0.5,(d:1,f:1):0.3):0.2):1;"
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0})
+        mySolver.az_partition()
+        mySolver.Estep()
+        free = mySolver.__free_edges__()
+        S = np.maximum(1e-6,mySolver.S_sum[:,free])
+        S = S/np.sum(S,axis=0)*mySolver.numsites
+        M,b = mySolver.ultrametric_constr()
+        bounds = optimize.Bounds(mySolver.dmin,mySolver.dmax)
+        d,status = optimize_brlen_closed_form(S,0,mySolver.dmin,mySolver.dmax)
+        d_newton,_ = optimize_brlen_separable(S,1e-6,mySolver.dmin,mySolver.dmax)
+        self.assertTrue(np.allclose(d,d_newton),msg="EMTest: test_64 failed.")
+        d,status = optimize_brlen_heights(S,0,mySolver.dmin,mySolver.dmax,mySolver.ultrametric_heights(),mySolver.brlen[free])
+        self.assertEqual(status,"optimal",msg="EMTest: test_64 failed.")
+        self.assertAlmostEqual(np.max(np.abs(M @ d - b)),0,places=8,msg="EMTest: test_64 failed.")
+        out = optimize.minimize(lambda x: -brlen_llh(x,S,0)[0],np.full(len(d),0.5),jac=lambda x: -brlen_llh(x,S,0)[1],method="SLSQP",bounds=bounds,constraints=[optimize.LinearConstraint(M,b,b)],options={'ftol':1e-12,'maxiter':1000})
+        self.assertAlmostEqual(brlen_llh(d,S,0)[0],-out.fun,places=5,msg="EMTest: test_64 failed.")
+
+    # test the scalar nu solver of the M-step against the conic formulation
+    def test_65(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        T = "(((a:1,b:0.5):0.2,e:0.3):1,(c:0.5,(d:1,f:1):0.3):0.2):1;"
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        mySolver.Estep()
+        free = mySolver.__free_edges__()
+        N = int(np.sum(free))
+        S = np.maximum(1e-6,mySolver.S_sum[:,free])
+        S = S/np.sum(S,axis=0)*mySolver.numsites
+        d = mySolver.brlen[free]
+        for nu_ini in [None,0.2,100]:
+            nu,status = optimize_nu_scalar(S,d,nu_ini=nu_ini)
+            self.assertEqual(status,"optimal",msg="EMTest: test_65 failed.")
+            prob,var_nu,_,(c,p_d,p_S24) = mySolver.__nu_conic_problem__(N)
+            c.value = np.dot(S[0]+S[1]+S[3],d)
+            p_d.value = d
+            p_S24.value = S[2]+S[4]
+            prob.solve(solver=cp.CLARABEL)
+            self.assertAlmostEqual(nu,float(var_nu.value),places=5,msg="EMTest: test_65 failed.")
+        # no silencing or dropout: nu = 0
+        S[2] = 0
+        S[4] = 0
+        self.assertEqual(optimize_nu_scalar(S,d),(0.0,"optimal"),msg="EMTest: test_65 failed.")
+
+    # test the llh of the tree combined at any internal node from its outside llh and the inside llh of its children
+    def test_66(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        T = "(((a:1,b:0.5):0.2,e:0.3):1,(c:0.5,(d:1,f:1):0.3):0.2):1;"
+
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        mySolver.Estep()
+        root = mySolver.roots[0]
+        for v in range(mySolver.num_nodes):
+            if mySolver.child[v] != -1:
+                self.assertTrue(np.allclose(mySolver.__site_llh__(v),mySolver.L0[root]),msg="EMTest: test_66 failed.")
+
+    # test the local branch-length optimization of an NNI against the EM with the same fixed branches
+    def test_67(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        T = "(((a:1,b:1):1,e:2):1,(c:1.5,(d:1,f:1):0.5):1.5):1;" # ultrametric
+
+        for ultra_constr in [False,True]:
+            mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+            brlen = mySolver.brlen.copy()
+            mySolver.az_partition()
+            llh = mySolver.lineage_llh()
+            for u in range(mySolver.num_nodes):
+                v = mySolver.parent[u]
+                if mySolver.child[u] == -1 or v == -1:
+                    continue
+                w = next(x for x in mySolver.__children__(v) if x != u)
+                for c in mySolver.__children__(u):
+                    nllh,status,undo = mySolver.optimize_local([(c,v),(w,u)],ultra_constr=ultra_constr)
+                    self.assertEqual(status,"optimal",msg="EMTest: test_67 failed.")
+                    # the same NNI on a new solver, optimized by the EM with all other branches fixed
+                    refSolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+                    u_node,v_node = refSolver.nodes[u],refSolver.nodes[v]
+                    refSolver.nni(u,c,w=w)
+                    free = [u_node.idx,v_node.idx] + refSolver.__children__(u_node.idx) + refSolver.__children__(v_node.idx)
+                    refSolver.mark_fixed[:] = True
+                    refSolver.mark_fixed[free] = False
+                    refSolver.az_partition()
+                    nllh_ref,_,_ = refSolver.EM_optimization(verbose=-1,optimize_phi=False,optimize_nu=False,ultra_constr=ultra_constr)
+                    self.assertAlmostEqual(nllh,nllh_ref,places=6,msg="EMTest: test_67 failed.")
+                    self.assertTrue(np.allclose(mySolver.brlen,refSolver.brlen,atol=1e-6),msg="EMTest: test_67 failed.")
+                    # undo: the cached outside llh are kept for the next move
+                    mySolver.move_subtrees(undo)
+                    mySolver.brlen[:] = brlen
+                    self.assertIsNotNone(mySolver.out_state,msg="EMTest: test_67 failed.")
+                    self.assertAlmostEqual(mySolver.lineage_llh(),llh,places=8,msg="EMTest: test_67 failed.")
+
+    # the arena is refreshed when the trees are rebuilt (same number of nodes, another topology)
+    def test_68(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        T1 = "(((a:1,b:1):1,e:2):1,(c:1.5,(d:1,f:1):0.5):1.5):1;"
+        T2 = "(((a:1,c:1):1,f:2):1,(b:1.5,(d:1,e:1):0.5):1.5):1;"
+
+        mySolver = EM_solver([T1],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        u = mySolver.child[mySolver.roots[0]]
+        v = mySolver.parent[u]
+        w = next(x for x in mySolver.__children__(v) if x != u)
+        _,_,undo = mySolver.optimize_local([(mySolver.child[u],v),(w,u)]) # fill the cache of optimize_local for T1
+        mySolver.move_subtrees(undo)
+        self.assertIsNotNone(mySolver.out_state,msg="EMTest: test_68 failed.")
+        mySolver.trees = [read_tree_newick(T2)]
+        mySolver.__build_topology__()
+        refSolver = EM_solver([T2],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        refSolver.az_partition()
+        self.assertAlmostEqual(mySolver.lineage_llh(),refSolver.lineage_llh(),places=8,msg="EMTest: test_68 failed.")
+        u = mySolver.child[mySolver.roots[0]] # the clade ((a,c),f)
+        v = mySolver.parent[u]
+        w = next(x for x in mySolver.__children__(v) if x != u)
+        c = mySolver.child[u]
+        nllh,status,_ = mySolver.optimize_local([(c,v),(w,u)])
+        nllh_ref,status_ref,_ = refSolver.optimize_local([(c,v),(w,u)])
+        self.assertEqual(status,"optimal",msg="EMTest: test_68 failed.")
+        self.assertAlmostEqual(nllh,nllh_ref,places=6,msg="EMTest: test_68 failed.")
+        self.assertTrue(np.allclose(mySolver.brlen,refSolver.brlen,atol=1e-6),msg="EMTest: test_68 failed.")
+
+    # multifurcating trees: the inside pass combines all children; optimize keeps the trees of the solver binary
+    def test_69(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8}]
+        msa = {'a':[1,-1,'?',0,2],'b':[1,'?','?',2,2],'c':[-1,1,0,'?',0],'d':[0,1,'?',-1,1],'e':[0,0,1,1,'?'],'f':[0,1,1,1,'?']}
+        T = "((a:1,b:1,e:2,c:0.5):1,(d:1,f:1):1.5):1;"
+        
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0,'nu':0.2})
+        mySolver.trees = [read_tree_newick(T)] # the unresolved tree
+        mySolver.__build_topology__()
+        refSolver = ML_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0,'nu':0.2})
+        self.assertAlmostEqual(mySolver.negative_llh(),refSolver.negative_llh(),places=8,msg="EMTest: test_69 failed.")
+        self.assertRaises(ValueError,mySolver.Estep_out_llh)
+        
+        mySolver = EM_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        num_nodes = mySolver.num_nodes
+        for _ in range(2):
+            nllh,status = mySolver.optimize(initials=1,verbose=-1)
+            self.assertEqual(mySolver.num_nodes,num_nodes,msg="EMTest: test_69 failed.")
+            self.assertAlmostEqual(mySolver.negative_llh(),nllh,places=6,msg="EMTest: test_69 failed.")
+            tree = read_tree_newick(mySolver.get_tree_newick()[0])
+            self.assertEqual(max(len(node.children) for node in tree.traverse_postorder()),4,msg="EMTest: test_69 failed.")
+
+    # find the duplicated cells (missing and silenced states included), from a dictionary or a CharMtrx
+    def test_70(self):
+        msa = {'a':[1,-1,'?',0],'b':[1,-1,'?',2],'c':[1,-1,'?',0],'d':[0,'?',1,2],'e':[1,-1,0,0],'f':[0,'?',1,2],'g':[1,-1,'?',0]}
+        true_groups = {'a':('a','c','g'),'d':('d','f')}
+        self.assertEqual(find_duplicate_cells(msa),true_groups,msg="EMTest: test_70 failed.")
+        self.assertEqual(find_duplicate_cells(encode_charMtrx(msa)),true_groups,msg="EMTest: test_70 failed.")
+        self.assertEqual(find_duplicate_cells({'a':[1,0],'b':[0,1]}),{},msg="EMTest: test_70 failed.")
@@ -1,8 +1,11 @@
 import os 
 import unittest
+import numpy as np
 from laml_libs.ML_solver import ML_solver
+from laml_libs.EM_solver import EM_solver
 from treeswift import *
 from laml_libs.sequence_lib import read_sequences
+from laml_libs.lca_lib import Anchor_index, find_LCAs
 
 class MLTest(unittest.TestCase):
     def test_1(self): 
@@ -272,3 +275,142 @@ class MLTest(unittest.TestCase):
         mySolver.az_partition()
         my_nllh = mySolver.negative_llh()
         self.assertAlmostEqual(true_nllh,my_nllh,places=5,msg="MLTest: test_21 failed.")
+
+    # test the analytic gradient against central finite differences
+    def test_22(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7},{1:0.2,2:0.8},{1:0.5,2:0.5}]
+        msa = {'a':[1,-1,'?',0,2,1],'b':[1,'?','?',2,2,1],'c':[-1,1,0,'?',0,1],'d':[0,1,'?',-1,1,'?'],'e':[1,1,'?',2,2,'?']}
+        T = "((a:1,b:0.5,e:0.3):1,(c:0.5,d:1):0.2):1;"
+
+        mySolver = ML_solver([T],{'charMtrx':msa,'leaf_weights':{'b':3}},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        x = np.array(list(mySolver.brlen) + [0.2,0.1])
+        def llh(x):
+            mySolver.x2params(x)
+            return mySolver.lineage_llh()
+        llh(x)
+        grad = mySolver.lineage_llh_grad()
+        h = 1e-6
+        for i in range(len(x)):
+            e = np.zeros(len(x))
+            e[i] = h
+            fd = (llh(x+e)-llh(x-e))/(2*h)
+            self.assertAlmostEqual(fd,grad[i],places=5,msg="MLTest: test_22 failed.")
+
+    # test the sparse ultrametric constraints
+    def test_23(self):
+        Q = [{1:1}]
+        msa = {'a':[1],'b':[1],'c':[1],'d':[0],'e':[1]}
+        for T,is_ultrametric in [("((((a:1,b:1):1,c:2):1,d:3):0.5,e:3.5):1;",True),("((((a:1,b:1):1,c:2):1,d:3):0.5,e:3):1;",False)]:
+            mySolver = ML_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0,'nu':0})
+            M = mySolver.ultrametric_constr()
+            self.assertEqual(M.shape,(4,mySolver.num_edges+2),msg="MLTest: test_23 failed.")
+            self.assertEqual(np.linalg.matrix_rank(M.toarray()),4,msg="MLTest: test_23 failed.")
+            x = np.array(list(mySolver.brlen) + [0,0])
+            self.assertEqual(np.allclose(M @ x,0),is_ultrametric,msg="MLTest: test_23 failed.")
+
+    # test that running the initial points in parallel gives the same result as running them sequentially
+    def test_24(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7}]
+        msa = {'a':[1,0,0,2],'b':[1,1,'?',2],'c':[0,1,0,'?'],'d':[0,1,1,0],'e':[1,0,'?',2]}
+        T = "(((a,b),e),(c,d));"
+        results = []
+        for threads in [1,2]:
+            mySolver = ML_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0,'nu':0})
+            nllh,_ = mySolver.optimize(initials=3,verbose=-1,random_seeds=1984,threads=threads)
+            results.append((nllh,mySolver.trees[0].newick()))
+        self.assertAlmostEqual(results[0][0],results[1][0],places=8,msg="MLTest: test_24 failed.")
+        self.assertEqual(results[0][1],results[1][1],msg="MLTest: test_24 failed.")
+
+    # test the incremental inside pass: only the dirty nodes are recomputed
+    def test_25(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7}]
+        msa = {'a':[1,0,0,2],'b':[1,1,'?',2],'c':[0,1,0,'?'],'d':[0,1,1,0],'e':[1,0,'?',2]}
+        T = "((((a:1,b:1):1,c:2):1,d:3):0.5,e:3.5):1;"
+        T_new = "((((a:0.5,b:1):1,c:2):1,d:3):0.5,e:3.5):1;"
+        for solver in [ML_solver,EM_solver]:
+            mySolver = solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+            mySolver.az_partition()
+            mySolver.lineage_llh()
+            a = [node.idx for node in mySolver.trees[0].traverse_leaves() if node.label == 'a'][0]
+            mySolver.brlen[a] = 0.5
+            path = []
+            i = a
+            while i != -1:
+                path.append(i)
+                i = mySolver.parent[i]
+            dirty = mySolver.__dirty_nodes__()
+            self.assertEqual(sorted(dirty),sorted(path),msg="MLTest: test_25 failed.")
+            mySolver.mark_dirty(dirty)
+            trueSolver = solver([T_new],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+            trueSolver.az_partition()
+            self.assertAlmostEqual(mySolver.lineage_llh(),trueSolver.lineage_llh(),places=8,msg="MLTest: test_25 failed.")
+            # a change of phi or nu makes all nodes dirty
+            mySolver.params.phi = 0.2
+            trueSolver.params.phi = 0.2
+            self.assertEqual(len(mySolver.__dirty_nodes__()),mySolver.num_nodes,msg="MLTest: test_25 failed.")
+            mySolver.mark_dirty(range(mySolver.num_nodes))
+            self.assertAlmostEqual(mySolver.lineage_llh(),trueSolver.lineage_llh(),places=8,msg="MLTest: test_25 failed.")
+            self.assertEqual(len(mySolver.__dirty_nodes__()),0,msg="MLTest: test_25 failed.")
+
+    def test_26(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7}]
+        msa = {'a':[1,0,0,2],'b':[1,1,'?',2],'c':[0,1,0,'?'],'d':[0,1,1,0],'e':[1,0,'?',2]}
+        T = "((((a:1,b:1):1,c:2):1,d:3):0.5,e:3.5):1;"
+        for solver in [ML_solver,EM_solver]:
+            mySolver = solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+            mySolver.az_partition()
+            llh = mySolver.lineage_llh()
+            internals = [node for node in mySolver.trees[0].traverse_postorder() if not node.is_leaf() and not node.is_root()]
+            for u in internals:
+                for c in u.child_nodes():
+                    # the NNI on the live solver is the same as a new solver on the new tree
+                    undo = mySolver.nni(u.idx,c.idx)
+                    trueSolver = solver(mySolver.get_tree_newick(),{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+                    trueSolver.az_partition()
+                    self.assertTrue(np.all(mySolver.parent[:-1] > np.arange(mySolver.num_nodes-1)),msg="MLTest: test_26 failed.")
+                    self.assertAlmostEqual(mySolver.lineage_llh(),trueSolver.lineage_llh(),places=8,msg="MLTest: test_26 failed.")
+                    # undo
+                    mySolver.move_subtrees(undo)
+                    self.assertEqual(mySolver.get_tree_newick(),[T],msg="MLTest: test_26 failed.")
+                    self.assertAlmostEqual(mySolver.lineage_llh(),llh,places=8,msg="MLTest: test_26 failed.")
+
+    # test the anchor index of the solver after NNI moves
+    def test_27(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7}]
+        msa = {'a':[1,0,0,2],'b':[1,1,'?',2],'c':[0,1,0,'?'],'d':[0,1,1,0],'e':[1,0,'?',2],'f':[0,0,1,2]}
+        T = "((((a:1,b:1):1,c:2):1,(d:1,f:1):2):0.5,e:3.5):1;"
+        labels = sorted(msa)
+        queries = [(x,y) for x in labels for y in labels]
+        mySolver = ML_solver([T],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        index = mySolver.__anchor_index__()[0]
+        for _ in range(2):
+            internals = [node for node in mySolver.trees[0].traverse_postorder() if not node.is_leaf() and not node.is_root()]
+            for u in internals:
+                for c in u.child_nodes():
+                    undo = mySolver.nni(u.idx,c.idx)
+                    tree = read_tree_newick(mySolver.get_tree_newick()[0])
+                    # the updated index is the same as a new one, and it finds the same LCAs as find_LCAs
+                    self.assertEqual(sorted(index.nodes),sorted(Anchor_index(tree).nodes),msg="MLTest: test_27 failed.")
+                    for anchors,node in index.nodes.items():
+                        self.assertEqual(node.anchors,anchors,msg="MLTest: test_27 failed.")
+                    for node,true_node in zip(index.find(queries),find_LCAs(tree,queries)):
+                        self.assertEqual(sorted(l.label for l in node.traverse_leaves()),sorted(l.label for l in true_node.traverse_leaves()),msg="MLTest: test_27 failed.")
+                    mySolver.move_subtrees(undo)
+            # accept a move
+            mySolver.nni(internals[-1].idx,internals[-1].child_nodes()[0].idx)
+
+    # the arena is refreshed when the trees are rebuilt with another number of nodes
+    def test_28(self):
+        Q = [{1:0.6,2:0.4},{1:1.0},{1:0.5,2:0.5},{1:0.3,2:0.7}]
+        msa = {'a':[1,0,0,2],'b':[1,1,'?',2],'c':[0,1,0,'?'],'d':[0,1,1,0],'e':[1,0,'?',2],'f':[0,0,1,2]}
+        T1 = "(((a:1,b:1,c:1):1,(d:1,f:1):1):0.5,e:2.5):1;"
+        T2 = "((((a:1,b:1):0.5,c:1.5):0.5,(d:1,f:1):1):0.5,e:2.5):1;"
+        mySolver = ML_solver([T1],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        mySolver.az_partition()
+        mySolver.lineage_llh()
+        mySolver.trees = [read_tree_newick(T2)]
+        mySolver.__build_topology__()
+        refSolver = ML_solver([T2],{'charMtrx':msa},{'Q':Q},{'phi':0.1,'nu':0.2})
+        refSolver.az_partition()
+        self.assertAlmostEqual(mySolver.lineage_llh(),refSolver.lineage_llh(),places=8,msg="MLTest: test_28 failed.")
@@ -243,3 +243,26 @@ class TopoSearchTest(unittest.TestCase):
 
         nllh_nni = -max_score
         self.assertAlmostEqual(nllh_bf,nllh_nni,places=4,msg="TopoSearchTest: test_10 failed.")
+    
+    # keep the polytomies: the live solver of the search must not rebuild its trees
+    def test_11(self):
+        Q = [{0:0, 1:1.0}, {0:0, 1:1.0}, {0:0, 1:1.0}, {0:0, 1:1.0}, {0:0, 1:1.0}]
+        msa = {'a':[1, 1, 0, 0, 0], 'b':[1, 1, 1, 0, 0], 'c':[0, 0, 0, 1, 0], 'd':[0, 0, 0, 1, 0]}
+        T0 = '((a,b),c,d);'
+        data = {'charMtrx':msa}
+        prior = {'Q':Q}
+        params = {'phi':0,'nu':0}
+        
+        for local_brlen_opt in [True,False]:
+            my_strategy = deepcopy(DEFAULT_STRATEGY)
+            my_strategy['local_brlen_opt'] = local_brlen_opt
+            my_strategy['fixed_brlen'] = None
+            mySolver = EM_solver([T0],data,prior,params)
+            init_score,_ = mySolver.score_tree(strategy=my_strategy)
+            myTopoSearch = Topology_search([T0],EM_solver,data=data,prior=prior,params=params)
+            best_tree,max_score,best_params = myTopoSearch.search(resolve_polytomies=False,maxiter=200,verbose=False,strategy=my_strategy,nreps=1)
+            self.assertTrue(max_score >= init_score-1e-6,msg="TopoSearchTest: test_11 failed.")
+            # the final score is the score of the output trees
+            mySolver = EM_solver(best_tree,data,prior,best_params)
+            score,_ = mySolver.score_tree(strategy=my_strategy)
+            self.assertAlmostEqual(score,max_score,places=4,msg="TopoSearchTest: test_11 failed.")
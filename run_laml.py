@@ -5,6 +5,7 @@ import laml_libs as scmail
 from laml_libs.sequence_lib import read_sequences, read_priors
 from laml_libs.ML_solver import ML_solver
 from laml_libs.EM_solver import EM_solver
+from laml_libs.duplicate_lib import find_duplicate_cells, collapse_duplicates, expand_duplicates
 from laml_libs.Topology_search_parallel import Topology_search_parallel as Topology_search_parallel
 from laml_libs.Topology_search import Topology_search as Topology_search_sequential
 from math import *
@@ -46,6 +47,7 @@ def main():
     inputOptions.add_argument("-p","--priors",required=False, default="uniform", help="The input prior matrix Q. Default: if not specified, use a uniform prior.")
     inputOptions.add_argument("--delimiter",required=False,default="comma",help="The delimiter of the input character matrix. Can be one of {'comma','tab','whitespace'} .Default: 'comma'.")
     inputOptions.add_argument("-m","--missing_data",required=False,default="?",help="Missing data character. Default: if not specified, assumes '?'.")
+    inputOptions.add_argument("--collapse_duplicates",action='store_true',required=False,help="Collapse each group of cells with identical character states (including missing data) into a single weighted leaf during the optimization. The duplicated cells are re-expanded in the output trees and annotations.")
     
     # output arguments
     outputOptions.add_argument("-o","--output",required=False,help="Output prefix. Default: LAML_output")
@@ -58,6 +60,10 @@ def main():
     numericalOptions.add_argument("--noSilence",action='store_true',help="Assume there is no gene silencing, but allow missing data by dropout in single cell sequencing.")
     numericalOptions.add_argument("--noDropout",action='store_true',help="Assume there is no sc-sequencing dropout, but allow missing data by gene silencing.")
     numericalOptions.add_argument("--nInitials",type=int,required=False,default=20,help="The number of initial points. Default: 20.")
+    numericalOptions.add_argument("--threads",type=int,required=False,default=1,help="The number of processes that run the initial points (see --nInitials) in parallel. Only used without topology search: --topology_search and --resolve_search score each tree from a single initial point (see --parallel to parallelize the topology search). Default: 1.")
+    numericalOptions.add_argument("--raceIters",type=int,required=False,default=0,help="Race the initial points (see --nInitials) of the EM solver: all initial points run this number of EM iterations, then only the ones close to the best (see --raceMargin) continue to convergence. Default: 0 (no racing).")
+    numericalOptions.add_argument("--raceMargin",type=float,required=False,default=1e-3,help="The initial points whose negative log-likelihood exceeds the best one by more than this relative margin after --raceIters EM iterations are dropped. Default: 1e-3.")
+    numericalOptions.add_argument("--accelerate",action='store_true',help="Accelerate the EM algorithm by SQUAREM extrapolation. Only works with the EM solver.")
     numericalOptions.add_argument("--randseeds",required=False,help="Random seeds for branch length optimization. Can be a single interger number or a list of intergers whose length is equal to the number of initial points (see --nInitials).")
 
     # Topology Search Arguments
@@ -104,6 +110,14 @@ def main():
         for line in f:
             input_trees.append(line.strip())
 
+    if args["collapse_duplicates"]:
+        duplicate_groups = find_duplicate_cells(msa)
+        input_trees,leaf_weights = collapse_duplicates(input_trees,duplicate_groups)
+        print("Collapsed " + str(sum(leaf_weights.values())) + " duplicated cells into " + str(len(leaf_weights)) + " weighted leaves")
+    else:
+        duplicate_groups = {}
+        leaf_weights = {}
+
     k = len(msa[next(iter(msa.keys()))])
     if args["compute_llh"]:
         fixed_lambda,fixed_phi,fixed_nu = [float(x) for x in args["compute_llh"].strip().split()]
@@ -145,7 +159,7 @@ def main():
         em_selected = False
 
     # main tasks        
-    data = {'charMtrx':msa} 
+    data = {'charMtrx':msa,'leaf_weights':leaf_weights} 
     prior = {'Q':Q} 
     
     params = {'nu':fixed_nu if fixed_nu is not None else scmail.eps,'phi':fixed_phi if fixed_phi is not None else scmail.eps}  
@@ -159,10 +173,7 @@ def main():
         print("Compute the joint likelihood of the input trees and specified parameters without any optimization")
         mySolver = myTopoSearch.get_solver()
         # [hacking] rescale the input branch lengths by the specified lambda
-        for tree in mySolver.trees:
-            for node in tree.traverse_preorder():
-                if node.edge_length is not None:
-                    node.edge_length *= fixed_lambda
+        mySolver.brlen *= fixed_lambda
         nllh = mySolver.negative_llh()
         opt_trees = myTopoSearch.treeTopoList
         opt_params = myTopoSearch.params
@@ -177,6 +188,8 @@ def main():
         resolve_polytomies = not args["keep_polytomies"]
         # only resolve polytomies or do full search?
         my_strategy['resolve_search_only'] = args["resolve_search"]
+        # accelerate the EM algorithm or not?
+        my_strategy['accelerate'] = args["accelerate"]
         # full search or local search to only resolve polytomies? 
         if not args["resolve_search"] and not args["topology_search"]:
             print("Optimizing branch lengths, phi, and nu without topology search")
@@ -185,11 +198,13 @@ def main():
             else:    
                 print("Optimization by generic solver (Scipy-SLSQP)")        
             mySolver = myTopoSearch.get_solver()
-            nllh = mySolver.optimize(initials=args["nInitials"],fixed_phi=fixed_phi,fixed_nu=fixed_nu,verbose=args["verbose"],random_seeds=random_seeds,ultra_constr=True) #args["ultrametric"]) # TODO: Remove this flag
+            nllh = mySolver.optimize(initials=args["nInitials"],fixed_phi=fixed_phi,fixed_nu=fixed_nu,verbose=args["verbose"],random_seeds=random_seeds,ultra_constr=True,threads=args["threads"],race_iters=args["raceIters"],race_margin=args["raceMargin"],accelerate=args["accelerate"]) #args["ultrametric"]) # TODO: Remove this flag
             myTopoSearch.update_from_solver(mySolver)
             opt_trees = myTopoSearch.treeTopoList
             opt_params = myTopoSearch.params
         else:
+            if args["threads"] > 1:
+                print("WARNING: --threads is ignored by the topology search, which scores each tree from a single initial point. Use --parallel to run the topology search in parallel.")
             if args["resolve_search"]:
                 if not resolve_polytomies:
                     print("WARNING: --resolve_search was specified with --keep_polytomies. Program will only optimize numerical parameters WITHOUT any topology search.")
@@ -226,6 +241,7 @@ def main():
         with open(out_tree,'w') as fout:
             for tstr in opt_trees:
                 tree = read_tree_newick(tstr)
+                expand_duplicates(tree,duplicate_groups)
                 #if not args['noSilence']:
                 # get the height of the tree
                 tree_height = tree.height(weighted=True) # includes the root's length, mutation units 
@@ -267,9 +283,22 @@ def main():
                         out += alpha + ":" + str(p_alpha)
                 return out
 
-        my_solver = EM_solver(opt_trees,{'charMtrx':msa},{'Q':Q},{'phi':opt_params['phi'],'nu':opt_params['nu']})
+        my_solver = EM_solver(opt_trees,{'charMtrx':msa,'leaf_weights':leaf_weights},{'Q':Q},{'phi':opt_params['phi'],'nu':opt_params['nu']})
         my_solver.az_partition()
         my_solver.Estep()
+        for tree in my_solver.trees:
+            for node in tree.traverse_postorder():
+                node.alpha = ['z' if a == 0 else '?' if a == -1 else a for a in my_solver.alpha[node.idx][my_solver.site_index]]
+                node.post0 = my_solver.post0[node.idx][my_solver.site_index]
+                node.post1 = my_solver.post1[node.idx][my_solver.site_index]
+            # the re-expanded duplicated cells share the posteriors of their representative
+            new_leaves = expand_duplicates(tree,duplicate_groups)
+            for leaf in new_leaves:
+                rep = new_leaves[leaf]
+                leaf.alpha = list(rep.alpha)
+                leaf.post0 = rep.post0
+                leaf.post1 = rep.post1
+                leaf.idx = None
         idx = 0
         with open(out_annotate,'w') as fout:
             for tree in my_solver.trees:
@@ -294,7 +323,10 @@ def main():
                         node.label = 'I' + str(idx)
                         idx += 1                    
                     all_labels.add(node.label)
-                    node.edge_length = round(sum(node.S1)+sum(node.S2)+sum(node.S4),3)
+                    if node.idx is None: # a re-expanded duplicated cell
+                        node.edge_length = 0
+                    else:    
+                        node.edge_length = round(my_solver.S_sum[1][node.idx]+my_solver.S_sum[2][node.idx]+my_solver.S_sum[4][node.idx],3)
 
                 fout.write(tree.newick()+"\n")    
                 